@@ -0,0 +1,376 @@
+"""Run the bot on asyncio: comments, inbox and exports as concurrent tasks
+
+    python -m immaginibot.aio
+
+Needs asyncpraw (`pip install immaginiBot[async]`), configured in praw.ini
+like the threaded bot. Replies are posted by up to `workers` tasks of the
+[pipeline] section of bot.toml.
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from . import export, metrics
+from .bot import BotComment, BotCore, ImageMatch
+from .models import REGISTRY
+from .utils import FORCE_TITLE_RE, GracefulDeath
+
+try:
+    import asyncpraw
+except ImportError:  # optional dependency
+    asyncpraw = None
+
+
+class AsyncImmaginiBot(BotCore):
+    """Bot to monitor comments and inbox, with asyncpraw"""
+
+    _comment_type = asyncpraw.models.Comment if asyncpraw is not None else ()
+
+    def __init__(self, reddit: "asyncpraw.Reddit | None" = None, settings: dict | None = None):
+        if asyncpraw is None and reddit is None:
+            raise RuntimeError("asyncpraw is not installed: pip install immaginiBot[async]")
+        super().__init__(settings)
+        self._reddit = reddit or asyncpraw.Reddit()
+        self._replies = asyncio.Semaphore(self.settings.get("pipeline", {}).get("workers", 4))
+        self._tasks: set[asyncio.Task] = set()
+
+    async def login(self) -> None:
+        me = await self._reddit.user.me()
+        self.username = me.name
+        self._logger.debug("Reddit login ok")
+        self._mainsubreddit = (await me.moderated())[0]
+        self._mods = await self._mainsubreddit.moderator()
+        self._creator = self._mods[0]
+
+    async def process_comment(self, comment, force=False) -> BotComment | None:
+        """Check for matches in a comment and reply, then store it as seen"""
+        if BotComment.get_by_parent(comment.id):
+            # already processed
+            self.seen_comments.add(comment)
+            return None
+        images = self.find_matches(comment)
+        if not images:
+            self.seen_comments.add(comment)
+            return None
+        botcomment = None
+        async with self._replies:
+            if not BotComment.get_by_parent(comment.id):
+                botcomment = await self.make_comment(comment, images, force)
+        # a failed reply stays held, processed again after a restart
+        self.seen_comments.add(comment)
+        return botcomment
+
+    async def make_comment(self, comment, images: list[ImageMatch], force=False) -> BotComment:
+        force = force or any(i.fuzzy for i in images)
+        body = self.reply_body(comment.id, images, force)
+        start = time.perf_counter()
+        reply = await comment.reply(body)
+        metrics.REPLY_SECONDS.observe(time.perf_counter() - start)
+        self._logger.info("Posted comment: %s -> %s", comment.permalink, reply.id)
+        bcomment = BotComment.from_parent(comment, reply.id)
+        BotComment.save(bcomment)
+        try:
+            edited = await self.to_richtext(images, bcomment, force)
+        except Exception as e:
+            metrics.RICHTEXT_EDITS.inc(result="error")
+            self._logger.error(e)
+        else:
+            metrics.RICHTEXT_EDITS.inc(result="ok" if edited else "skipped")
+            if edited:
+                bcomment.richtext = True
+                BotComment.save(bcomment)
+        return bcomment
+
+    async def to_richtext(self, images: list[ImageMatch], reply: BotComment, force=False) -> bool:
+        rtjson = self.richtext_json(images, reply.id, force)
+        if rtjson is None:
+            return False
+        await self._reddit.post(
+            "/api/editusertext",
+            data={
+                "api_type": "json",
+                "thing_id": f"t1_{reply.id}",
+                "richtext_json": rtjson,
+            },
+        )
+        return True
+
+    async def process_delete(self, body: str, author: str) -> None:
+        """If body and author match, delete child comments"""
+        comment = self.delete_target(body, author)
+        if not comment:
+            return
+        await (await self._reddit.comment(comment.id, fetch=False)).delete()
+        comment.deleted = True
+        self._logger.info("Deleted %s -> %s", comment.parent_id, comment.id)
+        BotComment.save(comment)
+
+    async def process_force(self, message) -> bool:
+        """Force a reply to a comment"""
+        if message.author not in self._mods:
+            self._logger.info("Not from mod: %s", message.id)
+            return False
+        match = FORCE_TITLE_RE.fullmatch(message.subject)
+        if not match:
+            self._logger.info("No comment id: %s", message.id)
+            return False
+        comment = await self._reddit.comment(match.group(1))
+        if not comment or comment.archived or not comment.author:
+            self._logger.info("Comment not valid: %s", message.subject)
+            return False
+        comment.body = message.body
+        self._logger.info("Force PM %s", message.fullname)
+        botcomment = await self.process_comment(comment, True)
+        if botcomment:
+            await message.reply(f"Fatto [commento]({comment.permalink})")
+        else:
+            self._logger.info("No image found: %s", comment.body)
+        return bool(botcomment)
+
+    async def process_inbox(self, messages: list) -> None:
+        """Run the delete and force commands of a batch, queue the rest for the creator"""
+        commands, forwards = self.triage(messages)
+        for message in commands:
+            if message.subject == "delete":
+                await self.process_delete(message.body, message.author.name)
+            else:
+                await self.process_force(message)
+        for message in forwards:
+            self.queue_forward(message)
+
+    async def _send_digest(self, force=False) -> None:
+        """Send the digest to the creator, if it is time or `force`"""
+        if not (force and self._digest) and not self.digest_due():
+            return
+        for subject, body in self.take_digest():
+            await self._creator.message(subject=subject, message=body)
+
+    def _spawn(self, coro) -> None:
+        """Run `coro` in a task, logging its errors"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.error("Task failed: %r", task.exception())
+
+    async def stream_comments(self) -> None:
+        """Reply to the comments of the first multireddit, forever"""
+        supervisor = self._comment_supervisor
+        while True:
+            await asyncio.sleep(supervisor.remaining())
+            try:
+                if self._source is None:
+                    self._source = (await (await self._reddit.user.me()).multireddits())[0]
+                supervisor.opened()
+                async for comment in self._source.stream.comments(pause_after=2):
+                    REGISTRY.reload_images()
+                    if comment is None:
+                        self._seen.flush()
+                        supervisor.caught_up()
+                        continue
+                    metrics.COMMENTS_SEEN.inc()
+                    metrics.STREAM_LAG_SECONDS.observe(time.time() - comment.created_utc)
+                    if comment in self.seen_comments:
+                        metrics.COMMENTS_SKIPPED.inc()
+                        continue
+                    self.seen_comments.hold(comment)
+                    self._spawn(self.process_comment(comment))
+            except asyncio.CancelledError:
+                raise
+            except Exception as expt:
+                self._logger.exception(expt)
+                supervisor.failure(expt)
+                if supervisor.breaker_open:
+                    self._source = None
+
+    async def stream_inbox(self) -> None:
+        """Process the inbox as messages arrive, forever"""
+        supervisor = self._inbox_supervisor
+        while True:
+            await asyncio.sleep(supervisor.remaining())
+            try:
+                supervisor.opened()
+                async for message in self._reddit.inbox.stream(pause_after=0):
+                    if message is None:
+                        await self._process_inbox_batch()
+                        await self._mark_read()
+                        await self._send_digest()
+                        supervisor.caught_up()
+                        continue
+                    if message in self.seen_messages:
+                        continue
+                    self.seen_messages.add(message)
+                    self._inbox_batch.append(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as expt:
+                self._logger.exception(expt)
+                supervisor.failure(expt)
+
+    async def _process_inbox_batch(self) -> None:
+        """Process the messages collected so far, kept on errors and cancellation"""
+        batch = list(self._inbox_batch)
+        # cancelled halfway, the whole batch is processed again at shutdown
+        await self.process_inbox(batch)
+        del self._inbox_batch[: len(batch)]
+
+    async def _mark_read(self) -> None:
+        if not self._unread:
+            return
+        items, self._unread = self._unread, []
+        await self._reddit.inbox.mark_read(items)
+
+    async def export_forever(self) -> None:
+        """Export the database every midnight"""
+        while True:
+            await asyncio.sleep(max((self._next_export - datetime.now()).total_seconds(), 0))
+            self._next_export = self._calculate_next_export()
+            try:
+                await self.export_to_profile()
+                await self.export_to_subreddit()
+            except asyncio.CancelledError:
+                raise
+            except Exception as expt:
+                self._logger.exception(expt)
+
+    async def export_to_profile(self) -> None:
+        """Export the database to the profile of the bot"""
+        title = "Istruzioni"
+        me = await self._reddit.user.me()
+        subreddit = await self._reddit.subreddit(me.subreddit.display_name)
+        # rendering the table is the slow part, keep it off the event loop
+        table = await asyncio.to_thread(export.export_md, False)
+        posts = [post async for post in subreddit.hot(limit=2)]
+        previous_post = None
+        for post in posts:
+            if post.stickied and post.title == title:
+                previous_post = post
+                break
+        with open(os.path.join("config", "export.txt"), encoding="utf8") as fexport:
+            template = fexport.read()
+        content_hash = export.digest(template, table)
+        if (
+            previous_post
+            and not previous_post.archived
+            and self._export_state.unchanged("profile", content_hash)
+        ):
+            self._logger.info("Export: %s unchanged", previous_post.permalink)
+            return
+        pages = export.split_table(table, export.SELFTEXT_LIMIT - len(template) - 1000)
+        extra = await self._publish_pages(subreddit, title, pages[1:], "profile")
+        body = template.format(
+            username=me.name,
+            tabella=pages[0] + self._page_links(extra),
+            ora=datetime.now().isoformat(),
+        )
+        if previous_post and not previous_post.archived:
+            await previous_post.edit(body)
+            self._logger.info("Export: updated %s", previous_post.permalink)
+        else:
+            if previous_post:
+                await self._reddit.user.pin(previous_post, state=False)
+                body = body + "\n\n [Istruzioni precedenti](" + previous_post.permalink + ")"
+                self._logger.info("Export: archived %s", previous_post.permalink)
+            submission = await subreddit.submit(title, selftext=body)
+            await self._reddit.user.pin(submission, state=True)
+            await submission.mod.lock()
+            self._logger.info("Export: new post %s", submission.permalink)
+        self._export_state.update("profile", content_hash, [p.id for p in extra])
+
+    async def export_to_subreddit(self) -> None:
+        """Export the subreddit"""
+        table = await asyncio.to_thread(export.export_md, True)
+        posts = [post async for post in self._mainsubreddit.hot(limit=1)]
+        previous_post = posts[0] if posts and posts[0].stickied else None
+        content_hash = export.digest(table)
+        if (
+            previous_post
+            and not previous_post.archived
+            and self._export_state.unchanged("subreddit", content_hash)
+        ):
+            self._logger.info("Export full: %s unchanged", previous_post.permalink)
+            return
+        pages = export.split_table(table, export.SELFTEXT_LIMIT - 1000)
+        extra = await self._publish_pages(
+            self._mainsubreddit, "Export full", pages[1:], "subreddit"
+        )
+        body = pages[0] + self._page_links(extra)
+        if previous_post and not previous_post.archived:
+            await previous_post.edit(body)
+        else:
+            if previous_post:
+                await previous_post.mod.sticky(state=False)
+            submission = await self._mainsubreddit.submit("Export full", selftext=body)
+            await submission.mod.sticky(state=True)
+            await submission.mod.lock()
+            self._logger.info("Export full: new post %s", submission.permalink)
+        self._export_state.update("subreddit", content_hash, [p.id for p in extra])
+
+    async def _publish_pages(self, subreddit, title: str, pages: list[str], target: str) -> list:
+        """Post the pages after the first, editing the ones of the last export"""
+        previous = self._export_state.pages(target)
+        submissions = []
+        for idx, page in enumerate(pages):
+            submission = None
+            if idx < len(previous):
+                submission = await self._reddit.submission(previous[idx])
+                if submission.archived:
+                    submission = None
+                else:
+                    await submission.edit(page)
+            if submission is None:
+                submission = await subreddit.submit(f"{title} ({idx + 2})", selftext=page)
+                await submission.mod.lock()
+                self._logger.info("Export: new page %s", submission.permalink)
+            submissions.append(submission)
+        for submission_id in previous[len(pages) :]:
+            await (await self._reddit.submission(submission_id, fetch=False)).delete()
+        return submissions
+
+    async def _wait_for_kill(self, sighandler: GracefulDeath, poll=0.5) -> None:
+        while not sighandler.received_kill:
+            await asyncio.sleep(poll)
+
+    async def run(self, shutdown_timeout=60.0) -> None:
+        """Stream comments and inbox and export, until SIGINT or SIGTERM"""
+        sighandler = GracefulDeath()
+        await self.login()
+        streams = [
+            asyncio.create_task(self.stream_comments(), name="comments"),
+            asyncio.create_task(self.stream_inbox(), name="inbox"),
+            asyncio.create_task(self.export_forever(), name="export"),
+        ]
+        try:
+            await self._wait_for_kill(sighandler)
+            self._logger.info("Ctrl+c found, extiting")
+        finally:
+            for task in streams:
+                task.cancel()
+            await asyncio.gather(*streams, return_exceptions=True)
+            if self._tasks:
+                self._logger.info("Waiting for %d replies", len(self._tasks))
+                await asyncio.wait(self._tasks, timeout=shutdown_timeout)
+            await self._process_inbox_batch()
+            await self._mark_read()
+            await self._send_digest(force=True)
+            await self._reddit.close()
+            self._seen.close()
+
+
+async def _run() -> None:
+    # asyncpraw needs the running loop
+    await AsyncImmaginiBot().run()
+
+
+def main():
+    """Perform bot actions"""
+    asyncio.run(_run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Match many comment bodies at once, offline
+
+    python -m immaginibot.batch comments.jsonl [--output matches.jsonl]
+
+The input has a JSON comment on each line, like the Reddit archive dumps
+(gzip, bz2 and xz are read as well): its `body` is matched as the bot would
+and a line `{"id", "matches": [[word, ext, keyword, fuzzy, images]]}` is
+written for each comment with candidates, `keyword` null when nothing
+matched. The words are resolved once for the whole input, by a pool of
+processes working on `--chunk-size` comments at a time.
+"""
+
+import argparse
+import bz2
+import gzip
+import itertools
+import json
+import lzma
+import sys
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import NamedTuple
+
+from .bot import BotCore, resolve_word
+from .models import REGISTRY
+from .utils import ANIM_EXT, normalize_word, scan_images
+
+
+class WordMatch(NamedTuple):
+    word: str
+    ext: str
+    keyword: str | None
+    fuzzy: bool
+    images: int
+
+
+class CommentMatches(NamedTuple):
+    id: str
+    matches: list[WordMatch]
+
+
+def _init_worker() -> None:
+    # the database is inherited with fork, loaded from the cache with spawn
+    _ = REGISTRY.images
+
+
+def extract_words(bodies: list[str]) -> list[list[tuple[str, str]]]:
+    """Normalized candidate words and extensions of each body, as `find_matches` sees them"""
+    return [
+        [(normalize_word(word), ext) for word, ext in scan_images(body, BotCore.MAX_CANDIDATES)]
+        for body in bodies
+    ]
+
+
+def resolve_words(words: list[tuple[str, bool]]) -> list[tuple[str | None, bool, int]]:
+    """Keyword, fuzzy and number of images of each (word, animated)"""
+    results = []
+    for word, animated in words:
+        keyword, fuzzy, images = resolve_word(word, animated)
+        results.append((keyword if images else None, fuzzy, len(images) if images else 0))
+    return results
+
+
+def _split(items: list, parts: int) -> list[list]:
+    size = max(1, -(-len(items) // parts))
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def _map(pool: Executor | None, func, items: list, parts: int) -> list:
+    """`func` on `parts` slices of `items`, the results joined in order"""
+    if pool is None:
+        return func(items)
+    return list(itertools.chain.from_iterable(pool.map(func, _split(items, parts))))
+
+
+def match_batch(
+    comments: Iterable[str | dict], workers=1, chunk_size=10_000
+) -> Iterator[CommentMatches]:
+    """Matches of each comment with candidate words, in the order of `comments`
+
+    A comment is its body or a dict with `body` and `id`; without an id the
+    position in `comments` is used. Each word is resolved only the first
+    time it is found.
+    """
+    # (word, animated) -> (keyword, fuzzy, images)
+    resolved: dict[tuple[str, bool], tuple[str | None, bool, int]] = {}
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker) if workers > 1 else None
+    try:
+        numbered = enumerate(comments)
+        while chunk := list(itertools.islice(numbered, chunk_size)):
+            ids = [str(c.get("id", idx)) if isinstance(c, dict) else str(idx) for idx, c in chunk]
+            bodies = [(c.get("body") or "") if isinstance(c, dict) else c for _, c in chunk]
+            candidates = _map(pool, extract_words, bodies, workers)
+            new = list(
+                {
+                    (word, ext.lower() in ANIM_EXT): None
+                    for words in candidates
+                    for word, ext in words
+                    if (word, ext.lower() in ANIM_EXT) not in resolved
+                }
+            )
+            resolved.update(zip(new, _map(pool, resolve_words, new, workers), strict=True))
+            for comment_id, words in zip(ids, candidates, strict=True):
+                if words:
+                    yield CommentMatches(
+                        comment_id,
+                        [
+                            WordMatch(word, ext, *resolved[(word, ext.lower() in ANIM_EXT)])
+                            for word, ext in words
+                        ],
+                    )
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _open(path: str):
+    if path == "-":
+        return sys.stdin
+    for ext, opener in ((".gz", gzip.open), (".bz2", bz2.open), (".xz", lzma.open)):
+        if path.endswith(ext):
+            return opener(path, "rt", encoding="utf8")
+    return open(path, encoding="utf8")
+
+
+def read_comments(path: str) -> Iterator[dict]:
+    """The JSON objects of each line of `path`, `-` for stdin"""
+    infile = _open(path)
+    try:
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match comment bodies against the images")
+    parser.add_argument("input", help="JSONL of comments, - for stdin")
+    parser.add_argument("--output", default="-", help="JSONL of the matches, - for stdout")
+    parser.add_argument("--workers", type=int, default=1, help="processes")
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="comments per round")
+    parser.add_argument("--top", type=int, default=0, help="print the N most missed words")
+    args = parser.parse_args()
+    _ = REGISTRY.images
+    missed: Counter[str] = Counter()
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf8")
+    try:
+        for result in match_batch(read_comments(args.input), args.workers, args.chunk_size):
+            outfile.write(json.dumps({"id": result.id, "matches": result.matches}))
+            outfile.write("\n")
+            missed.update(m.word for m in result.matches if m.keyword is None)
+    finally:
+        if outfile is not sys.stdout:
+            outfile.close()
+    for word, count in missed.most_common(args.top):
+        print(f"{count:8d} {word}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,754 @@
+"""Micro-benchmarks for the bot hot paths"""
+
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import random
+import shutil
+import string
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import unicodedata
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import toml
+from thefuzz import process as processfuzz
+from thefuzz.utils import full_process
+
+from . import models
+from .fuzzy import FuzzyMatcher, _bigrams
+from .media import MediaInfo, MediaResolver
+from .models import BotComment, Image, ImageSet
+from .richtext import RichtextTemplate
+from .storage import SqliteStore
+from .utils import ANIM_EXT, MAYBE_IMAGE, STATIC_EXT, normalize_word, scan_images
+
+
+def _random_word(rnd: random.Random, min_len=4, max_len=12) -> str:
+    return "".join(rnd.choices(string.ascii_lowercase, k=rnd.randint(min_len, max_len)))
+
+
+def synthetic_image_sets(count: int, seed=0, reused=0.0) -> set[ImageSet]:
+    """Build `count` random ImageSets, shaped like a real images.toml
+
+    A `reused` fraction of the images is also in another set."""
+    rnd = random.Random(seed)
+    image_sets = set()
+    previous: list[Image] = []
+    for idx in range(count):
+        key = f"{_random_word(rnd)}{idx}"
+        aliases = [_random_word(rnd) for _ in range(rnd.randint(0, 4))]
+        hiddens = [_random_word(rnd) for _ in range(rnd.randint(0, 1))]
+        images = set()
+        for _ in range(rnd.randint(1, 3)):
+            animated = rnd.random() < 0.3
+            ext = rnd.choice(ANIM_EXT if animated else STATIC_EXT)
+            url = f"https://i.imgur.com/{_random_word(rnd, 7, 7)}.{ext}"
+            images.add(Image(url, None, animated))
+        if previous and rnd.random() < reused:
+            images.add(rnd.choice(previous))
+        previous.extend(images)
+        image_sets.add(
+            ImageSet(
+                key,
+                frozenset([key] + aliases),
+                frozenset(images),
+                frozenset(hiddens),
+                rnd.random() < 0.05,
+            )
+        )
+    return image_sets
+
+
+def write_images_toml(path: str, image_sets) -> None:
+    """Write `image_sets` in the images.toml format"""
+    definitions = {}
+    for imageset in sorted(image_sets, key=lambda s: s.id):
+        definitions[imageset.id] = {
+            "aliases": sorted(imageset.keywords - {imageset.id}),
+            "hiddens": sorted(imageset.hidden_keywords),
+            "images": [
+                [i.url, i.reddit_id] if i.reddit_id else i.url
+                for i in sorted(imageset.images, key=lambda i: i.url)
+            ],
+            "hide": imageset.hide,
+        }
+    with open(path, "w", encoding="utf8") as outfile:
+        toml.dump(definitions, outfile)
+
+
+def _scan_get_images(image_sets, word: str, animated=None) -> list[Image] | None:
+    """Previous `get_images`: scan every keyword of every set"""
+    all_images_sets = [s for s in image_sets for i in s.keywords if i == word]
+    if not all_images_sets:
+        return None
+    if animated is not None:
+        a_images_set = [i for s in all_images_sets for i in s.images if i.animated == animated]
+        if a_images_set:
+            return a_images_set
+    return [i for s in all_images_sets for i in s.images]
+
+
+def bench_get_images(args) -> None:
+    """Keyword index lookup vs full scan"""
+    lookups, repeat = args.lookups, args.repeat
+    image_sets = synthetic_image_sets(args.sets)
+    models.REGISTRY.images = models.ImageDatabase(image_sets)
+    rnd = random.Random(1)
+    keywords = sorted(k for s in image_sets for k in s.keywords)
+    # half hits, half misses, random animated flag
+    words = [rnd.choice(keywords) for _ in range(lookups // 2)]
+    words += [_random_word(rnd) for _ in range(lookups - len(words))]
+    queries = [(w, rnd.choice([None, True, False])) for w in words]
+    hiddens = {k for s in image_sets for k in s.hidden_keywords}
+    for word, animated in queries:
+        if word in hiddens:
+            # the scan never looked at hidden keywords
+            continue
+        expected = _scan_get_images(image_sets, word, animated)
+        found = models.get_images(word, animated)
+        if sorted(expected or [], key=repr) != sorted(found or [], key=repr):
+            raise AssertionError(f"Mismatch on {word!r}")
+
+    def scan():
+        for word, animated in queries:
+            _scan_get_images(image_sets, word, animated)
+
+    def index():
+        for word, animated in queries:
+            models.get_images(word, animated)
+
+    _report("get_images scan", scan, lookups, repeat)
+    _report("get_images index", index, lookups, repeat)
+
+
+def _scan_fuzzy_word(image_sets, word: str) -> str | None:
+    """Previous `get_fuzzy_word`: score every keyword"""
+    keywords = [i for s in image_sets for i in s.keywords]
+    keyword, score = processfuzz.extractOne(word, keywords)  # type: ignore
+    if score > 93:
+        return keyword
+    return None
+
+
+def _corpus_words(path: str) -> list[str]:
+    """Candidate words of a file of comment bodies, as `find_matches` sees them"""
+    with open(path, encoding="utf8") as infile:
+        text = infile.read()
+    words = []
+    for match in MAYBE_IMAGE.findall(text):
+        word = unicodedata.normalize("NFD", match[0]).encode("ascii", "ignore").decode("utf8")
+        words.append("".join(c for c in word.lower() if c in string.ascii_lowercase + "_"))
+    return words
+
+
+def _old_normalize(word: str) -> str:
+    word = unicodedata.normalize("NFD", word).encode("ascii", "ignore").decode("utf8")
+    return "".join(c for c in word.lower() if c in string.ascii_lowercase + "_")
+
+
+_SCANNER_PIECES = [
+    "parola", "ciao", "x.jpg", "Foto.JPG", "b.gifv", ".png", "c.gif", ".mp4x", "perché.png",
+    " ", " ", " ", "\n", "\n", "> ", "^'", "^", "'", "è", "_", "1", "\t", ".", "a.jpeg",
+    "\r", "x.jpg.png", "http://e.com/i.png", "(", ")", "[img](u.jpg)",
+]  # fmt: skip
+
+
+def scanner_corpus(count: int, seed=4) -> list[str]:
+    """Random comment bodies mixing words, extensions, quotes and separators"""
+    rnd = random.Random(seed)
+    return ["".join(rnd.choices(_SCANNER_PIECES, k=rnd.randint(0, 40))) for _ in range(count)]
+
+
+def bench_scanner(args) -> None:
+    """scan_images vs MAYBE_IMAGE, checked on a regression corpus"""
+    corpus = scanner_corpus(args.lookups * 10)
+    if args.corpus:
+        with open(args.corpus, encoding="utf8") as infile:
+            text = infile.read()
+        corpus += [text] + text.split("\n\n")
+    for body in corpus:
+        expected = MAYBE_IMAGE.findall(body)
+        if scan_images(body) != expected:
+            raise AssertionError(f"scan_images differs on {body!r}")
+        for word, _ext in expected:
+            if normalize_word(word) != _old_normalize(word):
+                raise AssertionError(f"normalize_word differs on {word!r}")
+    print(f"scan_images matches MAYBE_IMAGE on {len(corpus)} bodies")
+    rnd = random.Random(5)
+    words = [_random_word(rnd) for _ in range(200)]
+    comments = []
+    for _ in range(20_000):
+        paragraphs = []
+        for _ in range(rnd.randint(1, 4)):
+            text = rnd.choices(words, k=rnd.randint(3, 60))
+            if rnd.random() < 0.03:
+                text.insert(rnd.randrange(len(text)), "facepalm.gif")
+            if rnd.random() < 0.1:
+                text.insert(0, ">")
+            paragraphs.append(" ".join(text))
+        comments.append("\n\n".join(paragraphs))
+    bodies = {
+        # one comment each, 3% with an image
+        "comments": comments,
+        # huge lines: no image at all, an image at the start, one at the end
+        "wall of text": [" ".join(rnd.choices(words, k=200_000))],
+        "wall, image first": ["fine.jpg " + " ".join(rnd.choices(words, k=200_000))],
+        "wall, image last": [" ".join(rnd.choices(words, k=200_000)) + " fine.jpg"],
+        "log paste": [
+            "\n".join(
+                f"{i} INFO {' '.join(rnd.choices(words, k=12))} file{i}.png" for i in range(20_000)
+            )
+        ],
+        "regression corpus": corpus,
+    }
+
+    def old(texts):
+        for body in texts:
+            [(_old_normalize(w), e) for w, e in MAYBE_IMAGE.findall(body)]
+
+    def new(texts):
+        for body in texts:
+            [(normalize_word(w), e) for w, e in scan_images(body)]
+
+    for name, texts in bodies.items():
+        size = sum(len(body.encode("utf8")) for body in texts) / 1e6
+        for label, func in (("MAYBE_IMAGE", old), ("scan_images", new)):
+            best = min(timeit.repeat(lambda: func(texts), number=1, repeat=args.repeat))  # noqa: B023
+            print(f"{label} {name:<20} {size / best:12.2f} MB/s")
+
+
+def _typo(rnd: random.Random, word: str) -> str:
+    pos = rnd.randrange(len(word))
+    return word[:pos] + rnd.choice(["", rnd.choice(string.ascii_lowercase)]) + word[pos + 1 :]
+
+
+def bench_fuzzy(args) -> None:
+    """FuzzyMatcher vs extractOne over all keywords"""
+    image_sets = synthetic_image_sets(args.sets)
+    keywords = [k for s in image_sets for k in s.keywords]
+    rnd = random.Random(2)
+    if args.corpus:
+        words = _corpus_words(args.corpus)
+    else:
+        # typos of known words, unknown words and the usual recurring misses
+        words = [_typo(rnd, rnd.choice(keywords)) for _ in range(args.lookups // 4)]
+        words += [_random_word(rnd) for _ in range(args.lookups // 4)]
+        words += rnd.choices(["file", "screenshot", "image", "foto"], k=args.lookups // 2)
+        rnd.shuffle(words)
+    words = words[: args.lookups]
+    # the old scan is slow, compare on a sample
+    for word in words[: max(1, args.lookups // 10)]:
+        expected = _scan_fuzzy_word(image_sets, word)
+        found = FuzzyMatcher(keywords).match(word)
+        if expected != found:
+            raise AssertionError(f"Mismatch on {word!r}: {expected!r} != {found!r}")
+
+    def scan():
+        for word in words:
+            _scan_fuzzy_word(image_sets, word)
+
+    matcher = FuzzyMatcher(keywords)
+    uncached = FuzzyMatcher(keywords, cache_size=0)
+
+    def prefilter():
+        for word in words:
+            uncached.match(word)
+
+    def cached():
+        for word in words:
+            matcher.match(word)
+
+    _report("get_fuzzy_word scan", scan, len(words), 1)
+    _report("FuzzyMatcher no cache", prefilter, len(words), args.repeat)
+    _report("FuzzyMatcher", cached, len(words), args.repeat)
+
+
+def bench_sqlite(args) -> None:
+    """SqliteStore lookups and inserts on a large history"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SqliteStore(os.path.join(tmpdir, "status.sqlite3"), BotComment)
+        batch = 100_000
+        for start in range(0, args.rows, batch):
+            store.save_many(
+                BotComment(f"r{i:07x}", f"p{i:07x}", f"u{i % 5000}")
+                for i in range(start, min(start + batch, args.rows))
+            )
+        rnd = random.Random(3)
+        parents = [f"p{rnd.randrange(args.rows):07x}" for _ in range(args.lookups)]
+        ids = [f"r{rnd.randrange(args.rows):07x}" for _ in range(args.lookups)]
+        misses = [f"x{i:07x}" for i in range(args.lookups)]
+        counter = iter(range(args.rows, args.rows * 2))
+
+        def by_parent():
+            for parent_id in parents:
+                store.get(parent_id)
+
+        def by_id():
+            for comment_id in ids:
+                store.get_by_id(comment_id)
+
+        def miss():
+            for parent_id in misses:
+                store.get(parent_id)
+
+        def insert():
+            for _ in range(args.lookups):
+                i = next(counter)
+                store.save(BotComment(f"r{i:07x}", f"p{i:07x}", "user"))
+
+        print(f"SqliteStore with {len(store)} rows")
+        _report("sqlite get by parent", by_parent, args.lookups, args.repeat)
+        _report("sqlite get by id", by_id, args.lookups, args.repeat)
+        _report("sqlite get missing", miss, args.lookups, args.repeat)
+        _report("sqlite insert", insert, args.lookups, args.repeat)
+        store.close()
+
+
+_STARTUP_SCRIPT = """
+import json, time
+t0 = time.perf_counter()
+from immaginibot import bot
+from immaginibot.replay import FakeReddit, _Done, synthetic_records
+t1 = time.perf_counter()
+reddit = FakeReddit([])
+immaginibot = bot.ImmaginiBot(reddit, {{}})
+immaginibot._logger.setLevel("WARNING")
+t2 = time.perf_counter()
+reddit.records = [r for r in synthetic_records({comments}) if r["kind"] == "comment"]
+immaginibot._stream_comments(reddit.comment_stream(), _Done(reddit), inbox=False)
+immaginibot._scheduler.close()
+t3 = time.perf_counter()
+replies = sum(a["action"] == "reply" for a in reddit.actions)
+print(json.dumps([t1 - t0, t2 - t1, t3 - t2, replies]))
+"""
+
+
+def bench_startup(args) -> None:
+    """Cold start: import, building the bot and the first pass of the comment stream
+
+    The bot reads a copy of the example templates and talks to a replay.FakeReddit.
+    """
+    image_sets = synthetic_image_sets(args.sets)
+    examples = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config")
+    comments = 1000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = os.path.join(tmpdir, "config")
+        os.mkdir(config)
+        write_images_toml(os.path.join(config, "images.toml"), image_sets)
+        for name in ("body.txt", "force.txt", "body.json", "force.json"):
+            shutil.copy(os.path.join(examples, name + ".EXAMPLE"), os.path.join(config, name))
+        with open(os.path.join(config, "status.jsonl"), "w") as outfile:
+            for i in range(args.sets):
+                outfile.write(
+                    json.dumps({"id": f"r{i}", "parent_id": f"p{i}", "parent_author": "u"})
+                )
+                outfile.write("\n")
+        script = _STARTUP_SCRIPT.format(comments=comments)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+        runs = []
+        for run in range(args.repeat):
+            # replies and seen ids of a run must not be seen by the next one
+            rundir = os.path.join(tmpdir, f"run{run}")
+            shutil.copytree(config, os.path.join(rundir, "config"))
+            output = subprocess.run(
+                [sys.executable, "-c", script],
+                cwd=rundir,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            # the bot logs to stdout before reading logging.json
+            runs.append(json.loads(output.splitlines()[-1]))
+    names = ["import bot", "build ImmaginiBot", f"stream {comments} comments"]
+    for idx, name in enumerate(names):
+        best = min(run[idx] for run in runs)
+        print(f"startup {name:<22} {best * 1e3:12.2f} ms  (best of {args.repeat})")
+    print(f"startup stream replies {runs[0][3]:15d}")
+
+
+def bench_cache(args) -> None:
+    """Parsing images.toml vs loading the binary cache"""
+    image_sets = synthetic_image_sets(args.sets)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "images.toml")
+        write_images_toml(path, image_sets)
+        parsed = models.ImageDatabase.from_toml(path)
+        cached = models.ImageDatabase.from_toml(path)
+        if parsed.keyword_index != cached.keyword_index:
+            raise AssertionError("Cache differs from images.toml")
+        print(f"images.toml with {len(parsed.image_sets)} sets")
+        _report(
+            "parse images.toml",
+            lambda: models.ImageDatabase.from_toml(path, cache=False),
+            1,
+            args.repeat,
+        )
+        _report("load cache", lambda: models.ImageDatabase.from_toml(path), 1, args.repeat)
+
+
+def _deepcopy_richtext(body, force, title, url, image_id, username, comment_id, force_par):
+    """Previous `richtext_json`: copy and fill the template, then `json.dumps`"""
+    rtjson = copy.deepcopy(body)
+    rtjson["document"][0]["c"][0]["t"] = title
+    rtjson["document"][0]["c"][0]["u"] = url
+    rtjson["document"][0]["c"][0]["f"][0][2] = len(title)
+    rtjson["document"][1]["id"] = image_id
+    for e in rtjson["document"][2]["c"]:
+        if "u" in e:
+            e["u"] = e["u"].format(username=username, comment_id=comment_id)
+    if force_par:
+        rtjson["document"] = [force] + rtjson["document"]
+    return json.dumps(rtjson)
+
+
+def bench_richtext(args) -> None:
+    """Precompiled RichtextTemplate vs deepcopy of the template"""
+    config = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config")
+    with open(os.path.join(config, "body.json.EXAMPLE"), encoding="utf8") as infile:
+        body = json.load(infile)
+    with open(os.path.join(config, "force.json.EXAMPLE"), encoding="utf8") as infile:
+        force = json.load(infile)
+    template = RichtextTemplate(body, force)
+    replies = [
+        (f"parola{i}.gif", f"https://i.redd.it/{i:x}.gif", f"{i:x}", "bot", f"r{i:x}", i % 5 == 0)
+        for i in range(args.lookups)
+    ]
+    for reply in replies:
+        if json.loads(template.render(*reply)) != json.loads(
+            _deepcopy_richtext(body, force, *reply)
+        ):
+            raise AssertionError(f"RichtextTemplate differs on {reply}")
+
+    def compiled():
+        for reply in replies:
+            template.render(*reply)
+
+    def deepcopied():
+        for reply in replies:
+            _deepcopy_richtext(body, force, *reply)
+
+    _report("richtext deepcopy", deepcopied, args.lookups, args.repeat)
+    _report("richtext template", compiled, args.lookups, args.repeat)
+
+
+@dataclass(frozen=True)
+class _DictImage:
+    url: str
+    reddit_id: str | None
+    animated: bool
+
+
+@dataclass(frozen=True)
+class _DictImageSet:
+    id: str
+    keywords: frozenset[str]
+    images: frozenset[_DictImage]
+    hidden_keywords: frozenset[str]
+    hide: bool = False
+
+
+def _read_definitions(path: str) -> dict:
+    with open(path, encoding="utf8") as infile:
+        return toml.load(infile)
+
+
+def _dict_image_sets(definitions: dict) -> list[_DictImageSet]:
+    """The sets of the toml `definitions` in the previous layout: no slots, nothing shared"""
+    image_sets = []
+    for key, value in definitions.items():
+        images = []
+        for item in value["images"]:
+            url, reddit_id = (item[0], item[1]) if isinstance(item, list) else (item, None)
+            images.append(_DictImage(url, reddit_id, url.rsplit(".", 1)[1] in ANIM_EXT))
+        image_sets.append(
+            _DictImageSet(
+                key,
+                frozenset([key.lower()] + [a.lower() for a in value["aliases"]]),
+                frozenset(images),
+                frozenset(h.lower() for h in value["hiddens"]),
+                value["hide"],
+            )
+        )
+    return image_sets
+
+
+class _ListFuzzyIndex:
+    """Index of the previous FuzzyMatcher: lists, a tuple for each posting"""
+
+    def __init__(self, keywords: list[str]):
+        self._keywords = list(dict.fromkeys(keywords))
+        self._multi: list[int] = []
+        self._by_length: dict[int, list[int]] = {}
+        self._postings: dict[str, list[tuple[int, int]]] = {}
+        self._lengths: list[int] = []
+        for kid, keyword in enumerate(self._keywords):
+            processed = full_process(keyword, force_ascii=True)
+            self._lengths.append(len(processed))
+            if not processed:
+                continue
+            if " " in processed:
+                self._multi.append(kid)
+                continue
+            self._by_length.setdefault(len(processed), []).append(kid)
+            for bigram, count in _bigrams(processed).items():
+                self._postings.setdefault(bigram, []).append((kid, count))
+
+
+@dataclass
+class _DictDatabase:
+    """What the previous ImageDatabase held"""
+
+    image_sets: dict[str, _DictImageSet]
+    # the parsed toml, to reuse the unchanged sets
+    sources: dict
+    keyword_sets: dict[str, set[str]]
+    keyword_index: dict[str, tuple[tuple[_DictImage, ...], tuple[_DictImage, ...]]]
+    keywords: list[str]
+    fuzzy_matcher: _ListFuzzyIndex
+
+
+def _dict_database(path: str) -> _DictDatabase:
+    """The database of `path` in the previous layout"""
+    definitions = _read_definitions(path)
+    image_sets = {s.id: s for s in _dict_image_sets(definitions)}
+    keyword_sets: dict[str, set[str]] = {}
+    for imageset in image_sets.values():
+        for keyword in imageset.keywords | imageset.hidden_keywords:
+            keyword_sets.setdefault(keyword, set()).add(imageset.id)
+    keyword_index = {}
+    for keyword, ids in keyword_sets.items():
+        images = [i for k in sorted(ids) for i in image_sets[k].images]
+        keyword_index[keyword] = (
+            tuple(i for i in images if not i.animated),
+            tuple(i for i in images if i.animated),
+        )
+    keywords = [k for s in image_sets.values() for k in s.keywords]
+    return _DictDatabase(
+        image_sets, definitions, keyword_sets, keyword_index, keywords, _ListFuzzyIndex(keywords)
+    )
+
+
+def _urls(keyword_index) -> dict[str, list[str]]:
+    return {k: sorted(i.url for i in s + a) for k, (s, a) in keyword_index.items()}
+
+
+def _traced(build):
+    """Result of `build()` and the bytes it still holds, measured by tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+_MEMORY_SCRIPT = """
+import json, sys
+from immaginibot import benchmark, models
+builds = {{
+    "legacy": lambda: benchmark._dict_database({path!r}),
+    "parsed": lambda: models.ImageDatabase.from_toml({path!r}, cache=False),
+    "cached": lambda: models.ImageDatabase.from_toml({path!r}),
+    "legacy sets": lambda: benchmark._dict_image_sets(benchmark._read_definitions({path!r})),
+    "sets": lambda: models.ImageDatabase.from_toml({path!r}, cache=False).image_sets,
+}}
+print(json.dumps(benchmark._traced(builds[sys.argv[1]])[1]))
+"""
+
+
+def bench_memory(args) -> None:
+    """Memory held by the image database and its sets, in the current and previous layout
+
+    Each layout is built in a new process, nothing interned or cached before.
+    """
+    image_sets = synthetic_image_sets(args.sets, reused=0.1)
+    images = len({i for s in image_sets for i in s.images})
+    sizes = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "images.toml")
+        write_images_toml(path, image_sets)
+        print(f"images.toml with {len(image_sets)} sets, {images} images")
+        del image_sets
+        database = models.ImageDatabase.from_toml(path)
+        legacy = _dict_database(path)
+        if _urls(database.keyword_index) != _urls(legacy.keyword_index) or set(
+            database.fuzzy_matcher._keywords
+        ) != set(legacy.fuzzy_matcher._keywords):
+            raise AssertionError("The database differs from the previous layout")
+        del database, legacy
+        script = _MEMORY_SCRIPT.format(path=path)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(__file__)))
+        for build in ("legacy", "parsed", "cached", "legacy sets", "sets"):
+            output = subprocess.run(
+                [sys.executable, "-c", script, build],
+                cwd=tmpdir,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            sizes[build] = json.loads(output)
+    for name, build in (
+        ("database, previous layout", "legacy"),
+        ("database from images.toml", "parsed"),
+        ("database from cache", "cached"),
+        ("sets, previous layout", "legacy sets"),
+        ("sets, current layout", "sets"),
+    ):
+        size = sizes[build]
+        print(f"memory {name:<26} {size / 2**20:10.1f} MiB {size / images:8.0f} B/image")
+
+
+def _media_bytes(ext: str, width: int, height: int) -> bytes:
+    """First bytes of an image of `width` x `height`"""
+    if ext == "png":
+        return b"\x89PNG\r\n\x1a\n" + struct.pack(">I4sII", 13, b"IHDR", width, height)
+    if ext == "gif":
+        return b"GIF89a" + struct.pack("<HH", width, height)
+    # APP0, then the start of frame
+    return (
+        b"\xff\xd8\xff\xe0"
+        + struct.pack(">H", 16)
+        + bytes(14)
+        + b"\xff\xc0"
+        + struct.pack(">HBHH", 17, 8, height, width)
+    )
+
+
+class _MediaService(BaseHTTPRequestHandler):
+    """Stand-in image host: /N.ext is an image N+1 pixels wide, the rest is missing"""
+
+    latency = 0.0
+    requests = 0
+    _types = {"png": "image/png", "gif": "image/gif", "jpg": "image/jpeg"}
+
+    def do_GET(self):  # noqa: N802
+        type(self).requests += 1
+        time.sleep(self.latency)
+        name, _, ext = self.path.lstrip("/").partition(".")
+        if not name.isdigit() or ext not in self._types:
+            self.send_error(404)
+            return
+        data = _media_bytes(ext, int(name) + 1, 2 * int(name) + 1)
+        self.send_response(206)
+        self.send_header("Content-Type", self._types[ext])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_media(args) -> None:
+    """MediaResolver against a stand-in image host, with one and with many threads"""
+    count, missing = args.lookups // 10, args.lookups // 100
+    handler = type("Handler", (_MediaService,), {"latency": 0.005})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler, bind_and_activate=False)
+    # room for all the connections of the resolver
+    server.request_queue_size = 64
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    exts = ("png", "gif", "jpg")
+    urls = [f"{base}/{i}.{exts[i % 3]}" for i in range(count)]
+    urls += [f"{base}/missing{i}.png" for i in range(missing)]
+    expected = {
+        url: MediaInfo(
+            f"up{i}", i + 1, 2 * i + 1, exts[i % 3] == "gif", handler._types[exts[i % 3]]
+        )
+        for i, url in enumerate(urls[:count])
+    }
+
+    def upload(url: str, content_type: str) -> str:
+        return "up" + url.rsplit("/", 1)[1].split(".")[0]
+
+    # the missing URLs are expected
+    logger = logging.getLogger("ImmaginiBot")
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for workers in (1, args.workers):
+                path = os.path.join(tmpdir, f"media{workers}.json")
+                resolver = MediaResolver(path, upload=upload, workers=workers)
+                start = time.perf_counter()
+                result = resolver.resolve(urls)
+                elapsed = time.perf_counter() - start
+                if result != (count, missing) or resolver.media != expected:
+                    raise AssertionError(f"MediaResolver with {workers} threads: {result}")
+                print(
+                    f"media {workers:3d} threads {elapsed * 1e3:12.1f} ms"
+                    f"  ({count} images, {missing} missing)"
+                )
+            # a rerun reads the cache and tries only the failed URLs again
+            handler.requests = 0
+            resolver = MediaResolver(path, upload=upload, workers=args.workers)
+            if resolver.pending(urls) != urls[count:] or resolver.resolve(urls) != (0, missing):
+                raise AssertionError("MediaResolver rerun resolved the cached URLs again")
+            if handler.requests != missing:
+                raise AssertionError(f"MediaResolver rerun made {handler.requests} requests")
+    finally:
+        logger.setLevel(level)
+        server.shutdown()
+        server.server_close()
+
+
+def _report(name: str, func, ops: int, repeat: int) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    per_op, unit = best * 1e6 / ops, "us"
+    if per_op >= 10_000:
+        per_op, unit = per_op / 1000, "ms"
+    print(f"{name:<30} {per_op:12.2f} {unit}/op  ({ops} ops, best of {repeat})")
+    return best
+
+
+BENCHMARKS = {
+    "get_images": bench_get_images,
+    "fuzzy": bench_fuzzy,
+    "sqlite": bench_sqlite,
+    "startup": bench_startup,
+    "cache": bench_cache,
+    "scanner": bench_scanner,
+    "richtext": bench_richtext,
+    "memory": bench_memory,
+    "media": bench_media,
+}
+
+
+def main():
+    """Run the selected benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("names", nargs="*", help="any of: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--sets", type=int, default=10000, help="synthetic ImageSets")
+    parser.add_argument("--lookups", type=int, default=2000, help="operations per run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--corpus", help="text file of real comment bodies")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="stored replies")
+    parser.add_argument("--workers", type=int, default=8, help="threads of the media resolver")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == "__main__":
+    main()
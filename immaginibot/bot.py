@@ -1,13 +1,13 @@
 """Manage Reddit bot"""
 
-import copy
+import functools
 import json
 import logging
 import os
 import random
-import re
 import sys
-import unicodedata
+import threading
+import time
 from datetime import datetime, timedelta
 from logging.config import dictConfig as logDigConfig
 from typing import NamedTuple, cast
@@ -15,20 +15,24 @@ from typing import NamedTuple, cast
 import praw
 from prawcore.exceptions import PrawcoreException
 
-from . import export
-from .models import BotComment, Image, get_fuzzy_word, get_images
+from . import export, metrics
+from .models import REGISTRY, BotComment, Image, ImageDatabase
+from .pipeline import Priority, RequestScheduler
+from .richtext import RichtextTemplate
+from .seen import SEEN_PATH, SeenStore
+from .supervisor import StreamSupervisor
 from .utils import (
     ANIM_EXT,
     DELETE_BODY_RE,
     FORCE_TITLE_RE,
-    MAYBE_IMAGE,
     STATIC_EXT,
-    BoundedSet,
+    CountingRequestor,
     GracefulDeath,
+    load_settings,
+    normalize_word,
+    scan_images,
 )
 
-ONLY_WORDS = re.compile("[^a-z_]")
-
 
 class ImageMatch(NamedTuple):
     word: str
@@ -37,49 +41,137 @@ class ImageMatch(NamedTuple):
     fuzzy: bool
 
 
-class ImmaginiBot:
-    """Bot to monitor comments and inbox"""
+def resolve_word(
+    word: str, animated: bool, database: ImageDatabase | None = None
+) -> tuple[str, bool, list[Image] | None]:
+    """Keyword, whether it was a fuzzy match and images of the normalized `word`"""
+    if database is None:
+        database = REGISTRY.images
+    candidates = database.get_images(word, animated)
+    if not candidates:
+        fuzzy_word = database.fuzzy_matcher.match(word)
+        if fuzzy_word:
+            return fuzzy_word, True, database.get_images(fuzzy_word, animated)
+    return word, False, candidates
+
+
+class WordCache:
+    """`resolve_word` of the raw words of the comments, the last `maxsize` used
+
+    Emptied when the image database is replaced. The images are kept as a
+    tuple, the caller picks one of them for each reply.
+    """
+
+    def __init__(self, maxsize=4096):
+        self._database: ImageDatabase | None = None
+        self._lock = threading.Lock()
+        self._lookup = functools.lru_cache(maxsize)(self._resolve)
+
+    @staticmethod
+    def _resolve(
+        raw_word: str, animated: bool, database: ImageDatabase
+    ) -> tuple[str, str, bool, tuple[Image, ...]]:
+        word = normalize_word(raw_word)
+        keyword, fuzzy, candidates = resolve_word(word, animated, database)
+        return word, keyword, fuzzy, tuple(candidates or ())
+
+    def get(self, raw_word: str, animated: bool) -> tuple[str, str, bool, tuple[Image, ...]]:
+        """Normalized word, keyword, fuzzy and images of `raw_word`"""
+        database = REGISTRY.images
+        if database is not self._database:
+            with self._lock:
+                if database is not self._database:
+                    self._lookup.cache_clear()
+                    self._database = database
+        result = self._lookup(raw_word, animated, database)
+        info = self._lookup.cache_info()
+        metrics.WORD_CACHE.set(info.hits, result="hit")
+        metrics.WORD_CACHE.set(info.misses, result="miss")
+        return result
+
+    def info(self):
+        """Hits, misses, maxsize and size, as `functools.lru_cache`"""
+        return self._lookup.cache_info()
 
-    def __init__(self):
+    def clear(self) -> None:
+        with self._lock:
+            self._lookup.cache_clear()
+            self._database = None
+
+
+WORDS = WordCache()
+
+
+class BotCore:
+    """What the bot does without talking to Reddit: matching and texts of the replies"""
+
+    # words looked up in a single comment, the rest is ignored
+    MAX_CANDIDATES = 20
+    # longest body of a private message
+    MESSAGE_LIMIT = 10000
+
+    username: str
+    _mods: list
+    # inbox items of this type are comments: mentions and replies
+    _comment_type: type | tuple = ()
+
+    def __init__(self, settings: dict | None = None):
         # logging
-        self.__init_logger()
-        # Reddit stuff
-        self._reddit = praw.Reddit()
-        self.username = self._reddit.user.me().name
-        self._logger.debug("Reddit login ok")
-        self.seen_comments = BoundedSet(150)
-        self.seen_messages = BoundedSet(150)
+        self._init_logger()
+        self.settings = load_settings() if settings is None else settings
+        REGISTRY.load()
+        metrics.start(self.settings.get("metrics", {}))
+        seen = self.settings.get("seen", {})
+        self._seen = SeenStore(
+            seen.get("path", SEEN_PATH),
+            seen.get("capacity", 100_000),
+            seen.get("error_rate", 0.001),
+            seen.get("max_hold", 600.0),
+        )
+        self.seen_comments = self._seen.window("comments")
+        # unread messages arrive in any order, no high-water mark
+        self.seen_messages = self._seen.window("inbox", use_mark=False)
+        # inbox items to mark as read at the end of the loop
+        self._unread: list = []
+        # new inbox messages, already in seen_messages, processed at the next pause
+        self._inbox_batch: list = []
+        # (subject, body) forwarded to the creator in the next digest
+        self._digest: list[tuple[str, str]] = []
+        self._digest_interval = self.settings.get("inbox", {}).get("digest_interval", 600.0)
+        self._last_digest = float("-inf")
+        streams = self.settings.get("streams", {})
+        self._comment_supervisor = StreamSupervisor("comments", **streams)
+        self._inbox_supervisor = StreamSupervisor("inbox", **streams)
+        # what the comments are streamed from, kept when the stream is opened again
+        self._source = None
+        self._inbox_stream = None
         self._next_export = self._calculate_next_export()
-        self._mainsubreddit = self._reddit.user.me().moderated()[0]
-        self._creator = self._mainsubreddit.moderator()[0]  # type: praw.reddit.Redditor
-        self._mods = list(self._mainsubreddit.moderator())  # type: list[praw.reddit.Redditor]
+        self._export_state = export.ExportState()
         # texts
         self.templates = {
             "body_txt": "",
             "force_txt": "",
-            "body_json": {},
-            "force_json": {},
         }
         with open(os.path.join("config", "body.txt"), encoding="utf8") as fbody:
             self.templates["body_txt"] = fbody.read()
         with open(os.path.join("config", "force.txt"), encoding="utf8") as fbody:
             self.templates["force_txt"] = fbody.read()
-        with open(os.path.join("config", "body.json"), encoding="utf8") as fbody:
-            self.templates["body_json"] = json.load(fbody)
-        with open(os.path.join("config", "force.json"), encoding="utf8") as fbody:
-            self.templates["force_json"] = json.load(fbody)
         del fbody
+        # a malformed template stops the bot here, not at the first reply
+        self.richtext = RichtextTemplate.from_files(
+            os.path.join("config", "body.json"), os.path.join("config", "force.json")
+        )
 
     @staticmethod
     def _calculate_next_export():
         """Return next midnight"""
         return datetime.now().replace(hour=0, minute=0) + timedelta(days=1)
 
-    def __init_logger(self):
+    def _init_logger(self):
         try:
             with open(os.path.join("config", "logging.json")) as logconfigf:
                 logDigConfig(json.load(logconfigf))
-            self._logger = logging.getLogger(self.__class__.__name__)
+            self._logger = logging.getLogger("ImmaginiBot")
         except OSError:
             self._logger = logging.getLogger(__name__)
             self._logger.setLevel(logging.DEBUG)
@@ -88,21 +180,16 @@ class ImmaginiBot:
             self._logger.debug("No logging.json, reverting to sysout")
 
     def find_matches(self, comment: praw.reddit.Comment) -> list[ImageMatch]:
-        matches = MAYBE_IMAGE.findall(comment.body)
+        matches = scan_images(comment.body, self.MAX_CANDIDATES)
         images: list[ImageMatch] = []
         for match in matches:
-            fuzzy = False
-            word = unicodedata.normalize("NFD", match[0]).encode("ascii", "ignore").decode("utf8")
-            word = word.lower()
-            word = ONLY_WORDS.sub("", word)
-            candiates = get_images(word, match[1].lower() in ANIM_EXT)
-            if not candiates:
-                fuzzy_word = get_fuzzy_word(word)
-                if fuzzy_word:
-                    fuzzy = True
-                    self._logger.info("Fuzzy %s -> %s", word, fuzzy_word)
-                    candiates = get_images(fuzzy_word, match[1].lower() in ANIM_EXT)
-                    word = fuzzy_word
+            normalized, word, fuzzy, candiates = WORDS.get(match[0], match[1].lower() in ANIM_EXT)
+            if fuzzy:
+                self._logger.info("Fuzzy %s -> %s", normalized, word)
+            if candiates:
+                metrics.WORD_HITS.inc(kind="fuzzy" if fuzzy else "exact")
+            else:
+                metrics.WORD_HITS.inc(kind="miss")
             if not candiates:
                 self._logger.info(
                     'Canditate found "%s" on comment %s',
@@ -113,95 +200,222 @@ class ImmaginiBot:
             else:
                 image = random.choice(candiates)
                 images.append(ImageMatch(word, match[1], image, fuzzy))
+        metrics.MATCHES.observe(len(images))
         return images
 
+    def reply_body(self, comment_id: str, images: list[ImageMatch], force=False) -> str:
+        """Markdown of the reply to `comment_id`"""
+        txts_img = []
+        for i in images:
+            ext = i.ext
+            if i.ext not in (ANIM_EXT if i.image.animated else STATIC_EXT):
+                ext = random.choice(ANIM_EXT if i.image.animated else STATIC_EXT)
+            txts_img.append(f"[{i.word}.{ext}]({i.image.url})")
+        return self.templates["body_txt" if not force else "force_txt"].format(
+            images="\n\n".join(txts_img),
+            username=self.username,
+            comment_id=comment_id,
+        )
+
+    def richtext_json(self, images: list[ImageMatch], reply_id: str, force=False) -> str | None:
+        """Serialized richtext of the reply `reply_id`, None if it stays markdown"""
+        if len(images) != 1:
+            return None
+        i = images[0]
+        if not i.image.reddit_id:
+            return None
+        ext = i.ext
+        if i.ext not in (ANIM_EXT if i.image.animated else STATIC_EXT):
+            ext = random.choice(ANIM_EXT if i.image.animated else STATIC_EXT)
+        return self.richtext.render(
+            f"{i.word}.{ext}", i.image.url, i.image.reddit_id, self.username, reply_id, force
+        )
+
+    def delete_target(self, body: str, author: str) -> BotComment | None:
+        """The reply to delete if `body` asks for it and `author` may do it"""
+        match = DELETE_BODY_RE.fullmatch(body)
+        if not match:
+            return None
+        comment = BotComment.get_by_parent(match.group(1))
+        if not comment:
+            return None
+        if author != comment.parent_author and author not in self._mods:
+            return None
+        return comment
+
+    def triage(self, messages: list) -> tuple[list, list]:
+        """Split a batch of inbox items into commands, to run first, and forwards
+
+        Items without author and replies to the bot are dropped, the others
+        are marked as read at the end of the loop."""
+        commands = []
+        forwards = []
+        for message in messages:
+            if not message.author:
+                continue
+            if isinstance(message, self._comment_type):
+                if message.subject in ("comment reply"):
+                    continue
+                self._logger.info("Username mention: %s", message.context)
+                forwards.append(message)
+            elif message.subject == "delete" or message.subject.lower().startswith("force "):
+                commands.append(message)
+            else:
+                forwards.append(message)
+            self._unread.append(message)
+        return commands, forwards
+
+    def queue_forward(self, message) -> None:
+        """Add `message` to the next digest for the creator"""
+        body = message.body
+        if isinstance(message, self._comment_type):
+            body = "\n\n".join([message.context, message.body])
+        self._digest.append((f"FW from {message.author.name}: {message.subject}", body))
+
+    def digest_due(self) -> bool:
+        return bool(self._digest) and (
+            time.monotonic() - self._last_digest >= self._digest_interval
+        )
+
+    def take_digest(self) -> list[tuple[str, str]]:
+        """Subject and body of the messages to the creator, the queued forwards merged"""
+        entries, self._digest = self._digest, []
+        self._last_digest = time.monotonic()
+        separator = "\n\n---\n\n"
+        chunks: list[list[tuple[str, str]]] = []
+        size = 0
+        for subject, body in entries:
+            length = len(subject) + len(body) + 8 + len(separator)
+            if not chunks or size + length > self.MESSAGE_LIMIT:
+                chunks.append([])
+                size = 0
+            chunks[-1].append((subject, body))
+            size += length
+        messages = []
+        for chunk in chunks:
+            if len(chunk) == 1:
+                subject, body = chunk[0]
+                messages.append((subject, body[: self.MESSAGE_LIMIT]))
+            else:
+                body = separator.join(f"**{subject}**\n\n{body}" for subject, body in chunk)
+                messages.append((f"Inbox: {len(chunk)} messages", body))
+        return messages
+
+    @staticmethod
+    def _page_links(pages: list) -> str:
+        if not pages:
+            return ""
+        links = (f"[{idx + 2}]({page.permalink})" for idx, page in enumerate(pages))
+        return "\n\nPagine: " + " ".join(links)
+
+
+class ImmaginiBot(BotCore):
+    """Bot to monitor comments and inbox"""
+
+    _comment_type = praw.models.Comment
+
+    def __init__(self, reddit: praw.Reddit | None = None, settings: dict | None = None):
+        super().__init__(settings)
+        # Reddit stuff
+        self._reddit = reddit or praw.Reddit(requestor_class=CountingRequestor)
+        self.username = self._reddit.user.me().name
+        self._logger.debug("Reddit login ok")
+        self._mainsubreddit = self._reddit.user.me().moderated()[0]
+        self._creator = self._mainsubreddit.moderator()[0]  # type: praw.reddit.Redditor
+        self._mods = list(self._mainsubreddit.moderator())  # type: list[praw.reddit.Redditor]
+        self._scheduler = RequestScheduler(
+            self._logger, lambda: self._reddit.auth.limits, **self.settings.get("pipeline", {})
+        )
+        self._digests = 0
+
     def process_comment(self, comment: praw.reddit.Comment, force=False) -> None | BotComment:
-        """Check for matches in a comment and reply"""
+        """Check for matches in a comment and reply
+
+        Forced replies are posted right away, the others are queued. The
+        comment is stored as seen once handled, after its reply is saved."""
+        if self._scheduler.pending(comment.id):
+            # the queued reply stores it as seen
+            return None
         if BotComment.get_by_parent(comment.id):
             # already processed
+            self.seen_comments.add(comment)
             return None
         images = self.find_matches(comment)
         if not images:
+            self.seen_comments.add(comment)
             return None
-        return self.make_comment(comment, images, force)
+        if force:
+            return self.make_comment(comment, images, force)
+        self._scheduler.submit(comment.id, Priority.REPLY, self._reply, comment, images)
+        return None
+
+    def _reply(self, comment: praw.reddit.Comment, images: list[ImageMatch]) -> None:
+        """Post a queued reply, from a pipeline thread"""
+        if not BotComment.get_by_parent(comment.id):
+            self.make_comment(comment, images)
+        # a failed reply stays held, processed again after a restart
+        self.seen_comments.add(comment)
 
     def make_comment(
         self, comment: praw.reddit.Comment, images: list[ImageMatch], force=False
     ) -> BotComment:
-        txts_img = []
-        for i in images:
-            ext = i.ext
-            if i.ext not in (ANIM_EXT if i.image.animated else STATIC_EXT):
-                ext = random.choice(ANIM_EXT if i.image.animated else STATIC_EXT)
-            txts_img.append(f"[{i.word}.{ext}]({i.image.url})")
+        api_calls = CountingRequestor.count()
         force = force or any([i.fuzzy for i in images])
-        body = self.templates["body_txt" if not force else "force_txt"].format(
-            images="\n\n".join(txts_img),
-            username=self.username,
-            comment_id=comment.id,
-        )
-        reply = cast("praw.reddit.Comment", comment.reply(body))
+        body = self.reply_body(comment.id, images, force)
+        with metrics.REPLY_SECONDS.time():
+            reply = cast("praw.reddit.Comment", comment.reply(body))
         self._logger.info("Posted comment: %s -> %s", comment.permalink, reply.id)
-        bcomment = BotComment.from_reddit(reply)
-        edited = False
-        try:
-            edited = self.to_richtext(images, bcomment, force)
-        except Exception as e:
-            self._logger.error(e)
-        if edited:
-            bcomment.richtext = True
+        bcomment = BotComment.from_parent(comment, reply.id)
         BotComment.save(bcomment)
+        self._scheduler.submit(
+            f"edit:{reply.id}", Priority.EDIT, self._edit_richtext, images, bcomment, force
+        )
+        self._logger.debug(
+            "Reddit API calls for %s: %d", comment.id, CountingRequestor.count() - api_calls
+        )
         return bcomment
 
+    def _edit_richtext(self, images: list[ImageMatch], reply: BotComment, force=False) -> None:
+        """Turn a posted reply into richtext, from a scheduler thread"""
+        try:
+            edited = self.to_richtext(images, reply, force)
+        except Exception:
+            metrics.RICHTEXT_EDITS.inc(result="error")
+            raise
+        metrics.RICHTEXT_EDITS.inc(result="ok" if edited else "skipped")
+        if edited:
+            reply.richtext = True
+            BotComment.save(reply)
+
     def to_richtext(self, images: list[ImageMatch], reply: BotComment, force=False) -> bool:
-        if len(images) != 1:
-            return False
-        i = images[0]
-        if not i.image.reddit_id:
+        rtjson = self.richtext_json(images, reply.id, force)
+        if rtjson is None:
             return False
-        ext = i.ext
-        if i.ext not in (ANIM_EXT if i.image.animated else STATIC_EXT):
-            ext = random.choice(ANIM_EXT if i.image.animated else STATIC_EXT)
-        rtjson = copy.deepcopy(self.templates["body_json"])
-        rtjson["document"][0]["c"][0]["t"] = f"{i.word}.{ext}"
-        rtjson["document"][0]["c"][0]["u"] = i.image.url
-        rtjson["document"][0]["c"][0]["f"][0][2] = len(rtjson["document"][0]["c"][0]["t"])
-        rtjson["document"][1]["id"] = i.image.reddit_id
-        for e in rtjson["document"][2]["c"]:
-            if "u" in e:
-                e["u"] = e["u"].format(
-                    username=self.username,
-                    comment_id=reply.id,
-                )
-        if force:
-            rtjson["document"] = [self.templates["force_json"]] + rtjson["document"]
         z = self._reddit.post(
             "/api/editusertext",
             data={
                 "api_type": "json",
                 "thing_id": f"t1_{reply.id}",
-                "richtext_json": json.dumps(rtjson),
+                "richtext_json": rtjson,
             },
         )
-        self._logger.debug(json.dumps(rtjson))
+        self._logger.debug(rtjson)
         self._logger.debug(z)
         return True
 
     def process_delete(self, body: str, author: str) -> None:
         """If body and author match, delete child comments"""
-        match = DELETE_BODY_RE.fullmatch(body)
-        if not match:
-            return
-        comment_id = match.group(1)
-        comment = BotComment.get_by_parent(comment_id)
+        comment = self.delete_target(body, author)
         if not comment:
             return
-        if author != comment.parent_author and author not in self._mods:
-            return
+        self._scheduler.submit(f"delete:{comment.id}", Priority.DELETE, self._delete, comment)
+
+    def _delete(self, comment: BotComment) -> None:
+        """Delete a reply of the bot, from a scheduler thread"""
         self._reddit.comment(id=comment.id).delete()
         comment.deleted = True
-        self._logger.info("Deleted %s -> %s", comment_id, comment.id)
-        BotComment.save()
+        self._logger.info("Deleted %s -> %s", comment.parent_id, comment.id)
+        BotComment.save(comment)
 
     def process_force(self, message) -> bool:
         """Force a reply to a comment"""
@@ -226,31 +440,42 @@ class ImmaginiBot:
             self._logger.info("No image found: %s", comment.body)
         return bool(botcomment)
 
-    def process_inbox(self, message):
-        """Process different inbox messages: fw or delete"""
-        if not message.author:
+    def process_inbox(self, messages: list) -> None:
+        """Run the delete and force commands of a batch, queue the rest for the creator"""
+        commands, forwards = self.triage(messages)
+        for message in commands:
+            if message.subject == "delete":
+                self.process_delete(message.body, message.author.name)
+            else:
+                self.process_force(message)
+        for message in forwards:
+            self.queue_forward(message)
+
+    def _process_inbox_batch(self) -> None:
+        """Process the messages collected so far, kept if the stream fails before the pause"""
+        batch, self._inbox_batch = self._inbox_batch, []
+        self.process_inbox(batch)
+
+    def _send_digest(self, force=False) -> None:
+        """Queue the digest for the creator, if it is time or `force`"""
+        if not (force and self._digest) and not self.digest_due():
             return
-        if isinstance(message, praw.reddit.Comment):
-            if message.subject in ("comment reply"):
-                return
-            self._logger.info("Username mention: %s", message.context)
-            message.mark_read()
-            self._creator.message(
-                subject="FW from " + message.author.name + ": " + message.subject,
-                message="\n\n".join([message.context, message.body]),
+        for subject, body in self.take_digest():
+            self._digests += 1
+            self._scheduler.submit(
+                f"digest:{self._digests}",
+                Priority.FORWARD,
+                functools.partial(self._creator.message, subject=subject, message=body),
             )
+
+    def _mark_read(self) -> None:
+        """Mark the processed inbox items as read, with as few requests as possible"""
+        if not self._unread:
             return
-        message.mark_read()
-        if message.subject == "delete":
-            self.process_delete(message.body, message.author.name)
-        elif message.subject.lower().startswith("force "):
-            self.process_force(message)
-        else:
-            # Forward to creator
-            self._creator.message(
-                f"FW from {message.author.name}: {message.subject}",
-                message=message.body,
-            )
+        items, self._unread = self._unread, []
+        self._scheduler.submit(
+            f"mark_read:{items[0].id}", Priority.MARK_READ, self._reddit.inbox.mark_read, items
+        )
 
     def _stream_inbox(self, inbox_stream, sighandler):
         """Process all inbox message and returns"""
@@ -259,55 +484,115 @@ class ImmaginiBot:
                 break
             if not message:
                 self._logger.debug("One full loop done")
-                return
-            if message.id in self.seen_messages:
+                break
+            if message in self.seen_messages:
                 continue
-            self.seen_messages.add(message.id)
-            self.process_inbox(message)
+            self.seen_messages.add(message)
+            self._inbox_batch.append(message)
+        self._process_inbox_batch()
+        self._mark_read()
+        self._send_digest()
 
-    def _stream_comments(self, comment_stream, inbox_stream, sighandler):
-        """Process all comments and all inbox messages"""
+    def _poll_inbox(self, sighandler) -> None:
+        """Process the new inbox messages, unless the inbox stream is waiting after errors"""
+        supervisor = self._inbox_supervisor
+        if not supervisor.ready():
+            return
+        try:
+            if self._inbox_stream is None:
+                self._inbox_stream = self._reddit.inbox.stream(pause_after=0)
+                supervisor.opened()
+            self._stream_inbox(self._inbox_stream, sighandler)
+        except PrawcoreException as prawexcept:
+            self._logger.debug(prawexcept)
+            self._inbox_stream = None
+            supervisor.failure(prawexcept)
+            return
+        except Exception as expt:
+            self._logger.exception(expt)
+            self._inbox_stream = None
+            supervisor.failure(expt)
+            return
+        supervisor.caught_up()
+
+    def _stream_comments(self, comment_stream, sighandler, inbox=True):
+        """Process all comments and, with `inbox`, all inbox messages"""
         for comment in comment_stream:
             if sighandler.received_kill:
                 break
+            REGISTRY.reload_images()
             if comment:
-                if comment.id in self.seen_comments:
+                metrics.COMMENTS_SEEN.inc()
+                metrics.STREAM_LAG_SECONDS.observe(time.time() - comment.created_utc)
+                if comment in self.seen_comments:
+                    metrics.COMMENTS_SKIPPED.inc()
                     continue
-                self.seen_comments.add(comment.id)
+                self.seen_comments.hold(comment)
                 self.process_comment(comment)
+                continue
+            self._seen.flush()
+            self._comment_supervisor.caught_up()
+            if inbox:
+                self._poll_inbox(sighandler)
+                self._schedule_export()
+
+    def _comment_source(self, subreddits: list[str] | None):
+        """Subreddit or multireddit streamed, looked up once"""
+        if self._source is None:
+            if subreddits:
+                self._source = self._reddit.subreddit("+".join(subreddits))
             else:
-                self._stream_inbox(inbox_stream, sighandler)
-                self.export_to_profile()
+                self._source = self._reddit.user.me().multireddits()[0]
+        return self._source
 
-    def stream_all(self):
-        """Monitor comments and inbox"""
-        sighandler = GracefulDeath()
+    def stream_all(self, subreddits: list[str] | None = None, inbox=True, sighandler=None):
+        """Monitor comments and inbox, until `sighandler` gets a kill
+
+        Only the comments of `subreddits` if given, of the first multireddit
+        otherwise. Without `inbox` messages and exports are left to another
+        worker. After an error a stream is opened again with a growing delay."""
+        sighandler = sighandler or GracefulDeath()
+        supervisor = self._comment_supervisor
         self._logger.debug("Starting first loop")
         while True:
+            supervisor.wait(sighandler)
+            if sighandler.received_kill:
+                break
             try:
-                if sighandler.received_kill:
-                    break
-                subreddit = self._reddit.user.me().multireddits()[0]
-                comment_stream = subreddit.stream.comments(pause_after=2)
-                inbox_stream = self._reddit.inbox.stream(pause_after=0)
-                self._stream_comments(comment_stream, inbox_stream, sighandler)
+                comment_stream = self._comment_source(subreddits).stream.comments(pause_after=2)
+                supervisor.opened()
+                self._stream_comments(comment_stream, sighandler, inbox)
             except PrawcoreException as prawexcept:
                 self._logger.debug(prawexcept)
+                supervisor.failure(prawexcept)
             except Exception as expt:
                 self._logger.exception(expt)
-                continue
+                supervisor.failure(expt)
+            if supervisor.breaker_open:
+                # maybe the multireddit is gone
+                self._source = None
         if sighandler.received_kill:
             self._logger.info("Ctrl+c found, extiting")
+        self._process_inbox_batch()
+        self._mark_read()
+        self._send_digest(force=True)
+        self._logger.info("Waiting for %d queued requests", len(self._scheduler))
+        self._scheduler.close()
+        self._seen.close()
 
-    def export_to_profile(self):
-        """Export the database every midnight"""
-        title = "Istruzioni"
+    def _schedule_export(self):
+        """Queue the exports every midnight"""
         if datetime.now() < self._next_export:
             return
         self._next_export = self._calculate_next_export()
+        self._scheduler.submit("export", Priority.EXPORT, self.export_to_profile)
+
+    def export_to_profile(self):
+        """Export the database to the profile of the bot, then to the subreddit"""
+        title = "Istruzioni"
         me = self._reddit.user.me()
         subreddit = cast("praw.reddit.Subreddit", self._reddit.subreddit(me.subreddit.display_name))
-        export_md = export.export_md(add_hidden=False)
+        table = export.export_md(add_hidden=False)
         posts = list(subreddit.hot())
         previous_post: "None | praw.reddit.Submission" = None
         if posts and posts[0] and posts[0].stickied and posts[0].title == title:
@@ -315,29 +600,56 @@ class ImmaginiBot:
         elif len(posts) > 1 and posts[1] and posts[1].stickied and posts[1].title == title:
             previous_post = posts[1]
         with open(os.path.join("config", "export.txt"), encoding="utf8") as fexport:
-            body = fexport.read()
-        body = body.format(username=me.name, tabella=export_md, ora=datetime.now().isoformat())
-        if previous_post and not previous_post.archived:
-            previous_post.edit(body)
-            self._logger.info("Export: updated %s", previous_post.permalink)
-        elif previous_post and previous_post.archived:
-            self._reddit.user.pin(previous_post, state=False)
-            body = body + "\n\n [Istruzioni precedenti](" + previous_post.permalink + ")"
-            self._logger.info("Export: archived %s", previous_post.permalink)
-        if not previous_post or previous_post.archived:
-            submission = subreddit.submit(title, selftext=body)
-            self._reddit.user.pin(submission, state=True)
-            submission.mod.lock()
-            self._logger.info("Export: new post %s", submission.permalink)
+            template = fexport.read()
+        content_hash = export.digest(template, table)
+        if (
+            previous_post
+            and not previous_post.archived
+            and self._export_state.unchanged("profile", content_hash)
+        ):
+            self._logger.info("Export: %s unchanged", previous_post.permalink)
+        else:
+            # room for the links to the other pages and the time
+            pages = export.split_table(table, export.SELFTEXT_LIMIT - len(template) - 1000)
+            extra = self._publish_pages(subreddit, title, pages[1:], "profile")
+            body = template.format(
+                username=me.name,
+                tabella=pages[0] + self._page_links(extra),
+                ora=datetime.now().isoformat(),
+            )
+            if previous_post and not previous_post.archived:
+                previous_post.edit(body)
+                self._logger.info("Export: updated %s", previous_post.permalink)
+            elif previous_post and previous_post.archived:
+                self._reddit.user.pin(previous_post, state=False)
+                body = body + "\n\n [Istruzioni precedenti](" + previous_post.permalink + ")"
+                self._logger.info("Export: archived %s", previous_post.permalink)
+            if not previous_post or previous_post.archived:
+                submission = subreddit.submit(title, selftext=body)
+                self._reddit.user.pin(submission, state=True)
+                submission.mod.lock()
+                self._logger.info("Export: new post %s", submission.permalink)
+            self._export_state.update("profile", content_hash, [p.id for p in extra])
         self.export_to_subreddit()
 
     def export_to_subreddit(self):
         """Export the subreddit"""
-        body = export.export_md(add_hidden=True)
+        table = export.export_md(add_hidden=True)
         existing_posts = list(self._mainsubreddit.hot())
         previous_post: "None | praw.reddit.Submission" = None
         if existing_posts and existing_posts[0] and existing_posts[0].stickied:
             previous_post = existing_posts[0]
+        content_hash = export.digest(table)
+        if (
+            previous_post
+            and not previous_post.archived
+            and self._export_state.unchanged("subreddit", content_hash)
+        ):
+            self._logger.info("Export full: %s unchanged", previous_post.permalink)
+            return
+        pages = export.split_table(table, export.SELFTEXT_LIMIT - 1000)
+        extra = self._publish_pages(self._mainsubreddit, "Export full", pages[1:], "subreddit")
+        body = pages[0] + self._page_links(extra)
         if previous_post and not previous_post.archived:
             previous_post.edit(body)
         elif previous_post and previous_post.archived:
@@ -347,6 +659,30 @@ class ImmaginiBot:
             submission.mod.sticky(state=True)
             submission.mod.lock()
             self._logger.info("Export full: new post %s", submission.permalink)
+        self._export_state.update("subreddit", content_hash, [p.id for p in extra])
+
+    def _publish_pages(
+        self, subreddit: "praw.reddit.Subreddit", title: str, pages: list[str], target: str
+    ) -> list["praw.reddit.Submission"]:
+        """Post the pages after the first, editing the ones of the last export"""
+        previous = self._export_state.pages(target)
+        submissions = []
+        for idx, page in enumerate(pages):
+            submission = None
+            if idx < len(previous):
+                submission = self._reddit.submission(id=previous[idx])
+                if submission.archived:
+                    submission = None
+                else:
+                    submission.edit(page)
+            if submission is None:
+                submission = subreddit.submit(f"{title} ({idx + 2})", selftext=page)
+                submission.mod.lock()
+                self._logger.info("Export: new page %s", submission.permalink)
+            submissions.append(submission)
+        for submission_id in previous[len(pages) :]:
+            self._reddit.submission(id=submission_id).delete()
+        return submissions
 
 
 def main():
@@ -1,50 +1,234 @@
-"""Export database"""
+"""Export database
 
-from collections import OrderedDict
+python -m immaginibot.export [--format md|csv|json] [--output FILE] [--no-hidden]
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Iterator
 from datetime import date
-from io import StringIO
 
 from praw import Reddit
 
-from .models import IMAGE_SETS
+from . import models
 
+_logger = logging.getLogger("ImmaginiBot")
 
-def export_md(add_hidden):
-    """Export database to markdown"""
-    imagesets = sorted(IMAGE_SETS, key=lambda i: i.id)
-    data = OrderedDict()
-    for imageset in imagesets:
-        if imageset.hide:
+# longest selftext accepted by Reddit, in characters
+SELFTEXT_LIMIT = 40000
+EXPORT_STATE = os.path.join("config", "export_state.json")
+_HEADER = "|Parola|Immagini|\n|:-|:-|\n"
+
+_lock = threading.Lock()
+# (set id, add_hidden) -> (set, markdown row), reused while the set is the same object
+_rows: dict[tuple[str, bool], tuple[models.ImageSet, str]] = {}
+# add_hidden -> (database, markdown table)
+_tables: dict[bool, tuple[models.ImageDatabase, str]] = {}
+
+
+def iter_imagesets(add_hidden, database: models.ImageDatabase | None = None):
+    """The sets sorted by id, with `add_hidden` also the hidden ones"""
+    database = database or models.REGISTRY.images
+    for key in sorted(database.image_sets):
+        imageset = database.image_sets[key]
+        if imageset.hide and not add_hidden:
             continue
-        data[imageset] = {
-            "urls": [image.url for image in imageset.images],
-            "keywords": imageset.keywords,
+        yield imageset
+
+
+def _keywords(imageset: models.ImageSet, add_hidden) -> list[str]:
+    keywords = sorted(imageset.keywords)
+    if add_hidden:
+        keywords += sorted(imageset.hidden_keywords - imageset.keywords)
+    return keywords
+
+
+def _urls(imageset: models.ImageSet) -> list[str]:
+    return sorted(image.url for image in imageset.images)
+
+
+def md_row(imageset: models.ImageSet, add_hidden) -> str:
+    images = " ".join(f"[{idx + 1}]({url})" for idx, url in enumerate(_urls(imageset)))
+    return f"|{', '.join(_keywords(imageset, add_hidden))}|{images}|\n"
+
+
+def iter_md(add_hidden) -> Iterator[str]:
+    """Markdown table, one row at a time"""
+    yield _HEADER
+    for imageset in iter_imagesets(add_hidden):
+        yield md_row(imageset, add_hidden)
+
+
+def iter_csv(add_hidden) -> Iterator[str]:
+    """CSV with a line for each image"""
+    writer = csv.writer(_Echo())
+    yield writer.writerow(("id", "keywords", "hidden_keywords", "hide", "url", "reddit_id"))
+    for imageset in iter_imagesets(add_hidden):
+        keywords = " ".join(sorted(imageset.keywords))
+        hidden = " ".join(sorted(imageset.hidden_keywords)) if add_hidden else ""
+        for image in sorted(imageset.images, key=lambda i: i.url):
+            yield writer.writerow(
+                (imageset.id, keywords, hidden, int(imageset.hide), image.url, image.reddit_id)
+            )
+
+
+def iter_json(add_hidden) -> Iterator[str]:
+    """JSON array with an object for each set"""
+    separator = "[\n"
+    for imageset in iter_imagesets(add_hidden):
+        item = {
+            "id": imageset.id,
+            "keywords": sorted(imageset.keywords),
+            "images": [
+                {"url": i.url, "reddit_id": i.reddit_id, "animated": i.animated}
+                for i in sorted(imageset.images, key=lambda i: i.url)
+            ],
         }
-    with StringIO() as ofile:
-        ofile.write("|Parola|Immagini|\n")
-        ofile.write("|:-|:-|\n")
-        for item in data.values():
-            if not item["keywords"]:
-                continue
-            ofile.write("|%s|" % ", ".join(item["keywords"]))
-            images = ["[%d](%s)" % ((idx + 1), url) for idx, url in enumerate(item["urls"])]
-            ofile.write(" ".join(images))
-            ofile.write("|\n")
-        return ofile.getvalue()
+        if add_hidden:
+            item["hidden_keywords"] = sorted(imageset.hidden_keywords)
+            item["hide"] = imageset.hide
+        yield separator + json.dumps(item, ensure_ascii=False)
+        separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+
+class _Echo:
+    """File for csv.writer, returning the line instead of writing it"""
+
+    def write(self, line: str) -> str:
+        return line
+
 
+FORMATS = {"md": iter_md, "csv": iter_csv, "json": iter_json}
 
-def export_md_file(add_hidden=True):
-    """Export images database to a markdown file"""
-    with open("export.md", mode="w", encoding="utf8") as ofile:
-        ofile.write(export_md(add_hidden))
+
+def write_export(path: str, fmt="md", add_hidden=True, chunk_size=1 << 16) -> None:
+    """Write the export to `path` in chunks of about `chunk_size` characters"""
+    chunk: list[str] = []
+    size = 0
+    with open(path + ".tmp", mode="w", encoding="utf8", newline="") as ofile:
+        for piece in FORMATS[fmt](add_hidden):
+            chunk.append(piece)
+            size += len(piece)
+            if size >= chunk_size:
+                ofile.write("".join(chunk))
+                chunk.clear()
+                size = 0
+        ofile.write("".join(chunk))
+    os.replace(path + ".tmp", path)
+
+
+def _cached_md_row(imageset: models.ImageSet, add_hidden) -> str:
+    cached = _rows.get((imageset.id, add_hidden))
+    if cached is not None and cached[0] is imageset:
+        return cached[1]
+    row = md_row(imageset, add_hidden)
+    _rows[(imageset.id, add_hidden)] = (imageset, row)
+    return row
+
+
+def export_md(add_hidden):
+    """Export database to markdown, building again only the rows of the changed sets"""
+    database = models.REGISTRY.images
+    with _lock:
+        cached = _tables.get(add_hidden)
+        if cached is not None and cached[0] is database:
+            return cached[1]
+        for key in [k for k in _rows if k[0] not in database.image_sets]:
+            del _rows[key]
+        rows = [_cached_md_row(s, add_hidden) for s in iter_imagesets(add_hidden, database)]
+        table = _HEADER + "".join(rows)
+        _tables[add_hidden] = (database, table)
+        return table
+
+
+def split_table(table: str, limit: int) -> list[str]:
+    """Split a markdown table in pages of at most `limit` characters, each with the header"""
+    rows = table.splitlines(keepends=True)
+    header = "".join(rows[:2])
+    pages: list[str] = []
+    page = [header]
+    size = len(header)
+    for row in rows[2:]:
+        if size + len(row) > limit and len(page) > 1:
+            pages.append("".join(page))
+            page = [header]
+            size = len(header)
+        page.append(row)
+        size += len(row)
+    pages.append("".join(page))
+    return pages
+
+
+def digest(*texts: str) -> str:
+    """Hash of what gets published"""
+    sha = hashlib.sha256()
+    for text in texts:
+        sha.update(text.encode("utf8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class ExportState:
+    """Hash and extra pages of the last export published to each target"""
+
+    def __init__(self, path=EXPORT_STATE):
+        self.path = path
+        try:
+            with open(path, encoding="utf8") as infile:
+                self._targets: dict[str, dict] = json.load(infile)
+        except FileNotFoundError:
+            self._targets = {}
+        except (OSError, ValueError) as expt:
+            _logger.warning("Ignoring %s: %s", path, expt)
+            self._targets = {}
+
+    def unchanged(self, target: str, content_hash: str) -> bool:
+        return self._targets.get(target, {}).get("hash") == content_hash
+
+    def pages(self, target: str) -> list[str]:
+        """Ids of the submissions with the pages after the first"""
+        return list(self._targets.get(target, {}).get("pages", []))
+
+    def update(self, target: str, content_hash: str, pages: list[str]) -> None:
+        self._targets[target] = {"hash": content_hash, "pages": pages}
+        with open(self.path + ".tmp", "w", encoding="utf8") as outfile:
+            json.dump(self._targets, outfile, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def export_md_file(add_hidden=True, path="export.md", fmt="md"):
+    """Export images database to a file, markdown by default"""
+    models.REGISTRY.load()
+    write_export(path, fmt, add_hidden)
 
 
 def export_reddit(add_hidden=False):
     """Export images database to Reddit"""
+    models.REGISTRY.load()
     reddit = Reddit()
     mainsubreddit = next(reddit.user.moderator_subreddits())
-    mainsubreddit.submit("Export " + date.today().isoformat(), export_md(add_hidden))
+    title = "Export " + date.today().isoformat()
+    pages = split_table(export_md(add_hidden), SELFTEXT_LIMIT)
+    for idx, page in enumerate(pages):
+        mainsubreddit.submit(
+            title if len(pages) == 1 else f"{title} ({idx + 1}/{len(pages)})", page
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the images database")
+    parser.add_argument("--format", choices=FORMATS, default="md")
+    parser.add_argument("--output", help="default export.FORMAT")
+    parser.add_argument("--no-hidden", action="store_true", help="skip hidden sets and keywords")
+    args = parser.parse_args()
+    export_md_file(not args.no_hidden, args.output or f"export.{args.format}", args.format)
 
 
 if __name__ == "__main__":
-    export_md_file(True)
+    main()
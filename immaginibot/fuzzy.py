@@ -0,0 +1,99 @@
+"""Fuzzy keyword matching"""
+
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import Iterable
+
+from thefuzz import process as processfuzz
+from thefuzz.utils import full_process
+
+# get_fuzzy_word accepts only scores > 93
+MIN_SCORE = 93
+# thefuzz rounds the similarity, prefilter with a bit of slack
+_MIN_RATIO = 0.93
+
+
+def _bigrams(word: str) -> Counter[str]:
+    return Counter(word[i : i + 2] for i in range(len(word) - 1))
+
+
+class FuzzyMatcher:
+    """Find the keyword most similar to a word, like `thefuzz.process.extractOne`
+
+    For single token strings WRatio is the plain Indel ratio, so only keywords
+    with a compatible length and enough shared bigrams can reach `MIN_SCORE`:
+    those are the only ones scored. Recent misses are remembered.
+    The index refers to the keywords by position, in compact arrays.
+    """
+
+    def __init__(self, keywords: Iterable[str], cache_size=1024):
+        self._keywords = list(dict.fromkeys(keywords))
+        self._cache_size = cache_size
+        self._misses: OrderedDict[str, None] = OrderedDict()
+        # keywords with more than one token are always scored
+        self._multi: list[int] = []
+        by_length: dict[int, list[int]] = {}
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        self._lengths = array("I")
+        for kid, keyword in enumerate(self._keywords):
+            processed = full_process(keyword, force_ascii=True)
+            self._lengths.append(len(processed))
+            if not processed:
+                continue
+            if " " in processed:
+                self._multi.append(kid)
+                continue
+            by_length.setdefault(len(processed), []).append(kid)
+            for bigram, count in _bigrams(processed).items():
+                kids, counts = postings.setdefault(bigram, ([], []))
+                kids.append(kid)
+                counts.append(count)
+        self._by_length = {k: array("I", v) for k, v in by_length.items()}
+        # bigram -> (keyword ids, occurrences in each keyword)
+        self._postings = {
+            b: (array("I", kids), array("I", counts)) for b, (kids, counts) in postings.items()
+        }
+
+    def _candidates(self, processed: str) -> list[int]:
+        """Ids of the keywords that could score more than `MIN_SCORE`"""
+        qlen = len(processed)
+        # minimum shared bigrams for each compatible length (q-gram lemma)
+        needed: dict[int, int] = {}
+        candidates = set(self._multi)
+        for klen in self._by_length:
+            if 2 * min(qlen, klen) < _MIN_RATIO * (qlen + klen):
+                continue
+            max_distance = int((qlen + klen) * (1 - _MIN_RATIO))
+            needed[klen] = max(qlen, klen) - 1 - 2 * max_distance
+            if needed[klen] <= 0:
+                candidates.update(self._by_length[klen])
+        shared: Counter[int] = Counter()
+        for bigram, qcount in _bigrams(processed).items():
+            kids, counts = self._postings.get(bigram, ((), ()))
+            for kid, kcount in zip(kids, counts, strict=True):
+                if self._lengths[kid] in needed:
+                    shared[kid] += min(qcount, kcount)
+        for kid, count in shared.items():
+            if count >= needed[self._lengths[kid]]:
+                candidates.add(kid)
+        return sorted(candidates)
+
+    def match(self, word: str) -> str | None:
+        """Return the closest keyword, if its score is greater than `MIN_SCORE`"""
+        if word in self._misses:
+            self._misses.move_to_end(word)
+            return None
+        processed = full_process(word, force_ascii=True)
+        if not processed:
+            choices = []
+        elif " " in processed:
+            choices = self._keywords
+        else:
+            choices = [self._keywords[kid] for kid in self._candidates(processed)]
+        result = processfuzz.extractOne(word, choices) if choices else None
+        if result and result[1] > MIN_SCORE:
+            return result[0]
+        self._misses[word] = None
+        if len(self._misses) > self._cache_size:
+            self._misses.popitem(last=False)
+        return None
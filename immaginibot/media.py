@@ -0,0 +1,283 @@
+"""Media ids, sizes and kind of the images of images.toml, resolved offline
+
+    python -m immaginibot.media [--workers N] [--upload SITE]
+
+The images without a reddit_id are fetched by a pool of threads, reading
+only their first bytes, and the results are stored in config/media.json,
+keyed by URL: running it again fetches only the new URLs. i.redd.it images
+take their id from the URL; the others get one only with --upload, which
+uploads them with the account of the praw.ini SITE. The bot reads
+config/media.json together with images.toml.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+from collections.abc import Callable, Iterable, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+
+import requests
+
+from .utils import ANIM_RE
+
+_logger = logging.getLogger("ImmaginiBot")
+
+MEDIA_PATH = os.path.join("config", "media.json")
+
+# id of the images hosted by Reddit, the name of the file
+_REDDIT_MEDIA_RE = re.compile(
+    r"^https?://(?:i|preview)\.redd\.it/(?:[^/?#]*-)?(\w+)\.\w+(?:[?#].*)?$", re.IGNORECASE
+)
+
+# enough for the size of PNG, GIF and most JPEG
+HEAD_BYTES = 64 * 1024
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    reddit_id: str | None
+    width: int | None
+    height: int | None
+    animated: bool
+    content_type: str = ""
+
+
+def reddit_media_id(url: str) -> str | None:
+    """The media id of an i.redd.it URL, None for the other hosts"""
+    match = _REDDIT_MEDIA_RE.match(url)
+    return match.group(1) if match else None
+
+
+def image_size(data: bytes) -> tuple[int, int] | None:
+    """Width and height from the first bytes of a PNG, GIF or JPEG"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        (length,) = struct.unpack(">H", data[pos + 2 : pos + 4])
+        # start of frame, except DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", data[pos + 5 : pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def probe(url: str, content_type: str, data: bytes) -> MediaInfo:
+    """MediaInfo of `url`, from its content type and its first bytes"""
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type.startswith("video/") or content_type == "image/gif":
+        animated = True
+    elif content_type.startswith("image/"):
+        animated = False
+    else:
+        animated = ANIM_RE.search(url) is not None
+    size = image_size(data)
+    return MediaInfo(
+        reddit_media_id(url),
+        size[0] if size else None,
+        size[1] if size else None,
+        animated,
+        content_type,
+    )
+
+
+class HttpFetcher:
+    """Content type and first `max_bytes` of a URL, one session per thread"""
+
+    def __init__(self, max_bytes=HEAD_BYTES, timeout=30.0):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers["User-Agent"] = "immaginibot media resolver"
+        return self._local.session
+
+    def __call__(self, url: str) -> tuple[str, bytes]:
+        with self.session.get(
+            url,
+            headers={"Range": f"bytes=0-{self.max_bytes - 1}"},
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            data = b""
+            for chunk in response.iter_content(8192):
+                data += chunk
+                if len(data) >= self.max_bytes:
+                    break
+            return response.headers.get("Content-Type", ""), data[: self.max_bytes]
+
+    def download(self, url: str, path: str) -> None:
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            with open(path, "wb") as outfile:
+                for chunk in response.iter_content(64 * 1024):
+                    outfile.write(chunk)
+
+
+class RedditUploader:
+    """Upload an image to Reddit, return its media id"""
+
+    _EXT = {"image/png": "png", "image/gif": "gif", "video/mp4": "mp4", "image/jpeg": "jpg"}
+
+    def __init__(self, reddit, fetcher: HttpFetcher):
+        self._reddit = reddit
+        self._fetcher = fetcher
+        self._subreddit = None
+        self._lock = threading.Lock()
+
+    def __call__(self, url: str, content_type: str) -> str:
+        with self._lock:
+            if self._subreddit is None:
+                me = self._reddit.user.me()
+                self._subreddit = self._reddit.subreddit(me.subreddit.display_name)
+        # praw picks the mime type from the extension of the file
+        ext = self._EXT.get(content_type, "jpg")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, f"image.{ext}")
+            self._fetcher.download(url, path)
+            return self._subreddit._upload_media(media_path=path, upload_type="selfpost")[0]
+
+
+def read_media(path: str = MEDIA_PATH) -> dict[str, MediaInfo]:
+    """The resolved URLs stored in `path`, empty if there is none"""
+    try:
+        with open(path, encoding="utf8") as infile:
+            return {url: MediaInfo(**info) for url, info in json.load(infile).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError, AttributeError) as expt:
+        _logger.warning("Ignoring %s: %s", path, expt)
+        return {}
+
+
+def write_media(path: str, media: Mapping[str, MediaInfo]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as outfile:
+        json.dump({url: asdict(media[url]) for url in sorted(media)}, outfile, indent=1)
+    os.replace(tmp_path, path)
+
+
+class MediaResolver:
+    """Resolve the URLs missing from the cache in `path`, with `workers` threads
+
+    `fetch(url)` returns the content type and the first bytes of the image,
+    `upload(url, content_type)` its Reddit media id. The cache is written
+    every `checkpoint` URLs, so an interrupted run is not lost.
+    """
+
+    def __init__(
+        self,
+        path: str = MEDIA_PATH,
+        fetch: Callable[[str], tuple[str, bytes]] | None = None,
+        upload: Callable[[str, str], str] | None = None,
+        workers=8,
+        checkpoint=100,
+    ):
+        self.path = path
+        self.fetch = fetch or HttpFetcher()
+        self.upload = upload
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.media = read_media(path)
+
+    def pending(self, urls: Iterable[str]) -> list[str]:
+        """The URLs to resolve: new, or without an id while uploading"""
+        pending = []
+        for url in dict.fromkeys(urls):
+            info = self.media.get(url)
+            if info is None or (self.upload is not None and info.reddit_id is None):
+                pending.append(url)
+        return pending
+
+    def _resolve(self, url: str) -> MediaInfo:
+        content_type, data = self.fetch(url)
+        info = probe(url, content_type, data)
+        if info.reddit_id is None and self.upload is not None:
+            reddit_id = self.upload(url, info.content_type)
+            info = MediaInfo(reddit_id, info.width, info.height, info.animated, info.content_type)
+        return info
+
+    def resolve(self, urls: Iterable[str]) -> tuple[int, int]:
+        """Resolve the pending `urls`, return how many were resolved and failed"""
+        pending = self.pending(urls)
+        resolved = failed = 0
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {pool.submit(self._resolve, url): url for url in pending}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    self.media[url] = future.result()
+                except Exception as expt:
+                    # not stored, tried again on the next run
+                    failed += 1
+                    _logger.warning("Cannot resolve %s: %s", url, expt)
+                    continue
+                resolved += 1
+                if resolved % self.checkpoint == 0:
+                    write_media(self.path, self.media)
+        if resolved:
+            write_media(self.path, self.media)
+        return resolved, failed
+
+
+def image_urls(path: str) -> list[str]:
+    """URLs of the images of `path` without a reddit_id"""
+    from .models import ImageDatabase
+
+    database = ImageDatabase.from_toml(path, cache=False)
+    return sorted(
+        {
+            image.url
+            for imageset in database.image_sets.values()
+            for image in imageset.images
+            if not image.reddit_id
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resolve the media of images.toml")
+    parser.add_argument("--images", default=os.path.join("config", "images.toml"))
+    parser.add_argument("--output", default=MEDIA_PATH)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--upload", metavar="SITE", help="upload to Reddit the other images")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    fetcher = HttpFetcher()
+    upload = None
+    if args.upload:
+        import praw
+
+        upload = RedditUploader(praw.Reddit(args.upload), fetcher)
+    resolver = MediaResolver(args.output, fetcher, upload, args.workers)
+    urls = image_urls(args.images)
+    _logger.info("%d images, %d to resolve", len(urls), len(resolver.pending(urls)))
+    resolved, failed = resolver.resolve(urls)
+    _logger.info("Resolved %d, failed %d, stored in %s", resolved, failed, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Counters and latency histograms of the bot, in Prometheus text format"""
+
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+_logger = logging.getLogger("ImmaginiBot")
+
+# longest profile, in seconds
+MAX_PROFILE_SECONDS = 60.0
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values) or {(): 0}
+        return [f"{self.name}{_format_labels(k)} {v}" for k, v in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets, optionally split by labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> (bucket counts, sum)
+        self._series: dict[tuple[tuple[str, str], ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1][0] += value
+
+    def time(self) -> "_Timer":
+        """Context manager observing the elapsed seconds"""
+        return _Timer(self)
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(tuple(sorted(labels.items())))
+        return sum(series[0]) if series else 0
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = {k: (list(c), t[0]) for k, (c, t) in self._series.items()}
+        if not series:
+            series = {(): ([0] * (len(self.buckets) + 1), 0.0)}
+        lines = []
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts, strict=True):
+                cumulative += count
+                labels = _format_labels(key + (("le", str(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._add(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, buckets))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All the metrics in Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+COMMENTS_SEEN = METRICS.counter("immaginibot_comments_seen_total", "Comments read from the stream")
+COMMENTS_SKIPPED = METRICS.counter(
+    "immaginibot_comments_skipped_total", "Comments skipped because already seen"
+)
+MATCHES = METRICS.histogram(
+    "immaginibot_matches_per_comment", "Images found in each comment", (0, 1, 2, 3, 5, 10, 20)
+)
+WORD_HITS = METRICS.counter("immaginibot_word_hits_total", "Words looked up: exact, fuzzy or miss")
+WORD_CACHE = METRICS.gauge(
+    "immaginibot_word_cache_lookups", "Lookups of the word cache since it was emptied, by result"
+)
+REPLY_SECONDS = METRICS.histogram("immaginibot_reply_seconds", "Time to post a reply")
+RICHTEXT_EDITS = METRICS.counter("immaginibot_richtext_edits_total", "Richtext edits, by result")
+STATUS_SAVE_SECONDS = METRICS.histogram(
+    "immaginibot_status_save_seconds",
+    "Time to save a BotComment",
+    (0.0001, 0.001) + LATENCY_BUCKETS,
+)
+STREAM_LAG_SECONDS = METRICS.histogram(
+    "immaginibot_stream_lag_seconds", "Age of the comments when read", LAG_BUCKETS
+)
+STREAM_FAILURES = METRICS.counter("immaginibot_stream_failures_total", "Errors of each stream")
+STREAM_OUTAGE_SECONDS = METRICS.histogram(
+    "immaginibot_stream_outage_seconds",
+    "From the first error of a stream to the end of its catch-up",
+    LAG_BUCKETS,
+)
+STREAM_CATCHUP_SECONDS = METRICS.histogram(
+    "immaginibot_stream_catchup_seconds",
+    "From opening a stream to its first pause, with the backlog processed",
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+STREAM_BREAKER_OPEN = METRICS.gauge(
+    "immaginibot_stream_breaker_open", "1 while a stream is not retried after many errors"
+)
+
+
+class SamplingProfiler:
+    """Sample the stacks of all threads every `interval` seconds"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._stacks: _Counter[str] = _Counter()
+        self._running = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._running.is_set()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stacks.clear()
+        self._running.set()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        """Stop sampling, return the stacks in collapsed format (flamegraph.pl, speedscope)"""
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        names = {}
+        while self._running.is_set():
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for ident, top in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                frame = top
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+
+PROFILER = SamplingProfiler()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    profiler_enabled = False
+
+    def do_GET(self):  # noqa: N802
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            self._send(METRICS.render(), "text/plain; version=0.0.4")
+        elif url.path == "/profile" and self.profiler_enabled:
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", ["10"])[0])
+            except ValueError:
+                seconds = math.nan
+            # nan fails both comparisons
+            if not 0 < seconds <= MAX_PROFILE_SECONDS:
+                self.send_error(
+                    400, f"seconds must be more than 0, at most {MAX_PROFILE_SECONDS:g}"
+                )
+                return
+            PROFILER.start()
+            time.sleep(seconds)
+            self._send(PROFILER.stop(), "text/plain")
+        else:
+            self.send_error(404)
+
+    def _send(self, body: str, content_type: str) -> None:
+        data = body.encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        _logger.debug("metrics: %s", format % args)
+
+
+def serve(port: int, host="127.0.0.1", profiler=False) -> ThreadingHTTPServer:
+    """Expose /metrics, and /profile?seconds=N if `profiler`, in a background thread"""
+    handler = type("Handler", (_Handler,), {"profiler_enabled": profiler})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def dump_forever(path: str, interval: float) -> threading.Thread:
+    """Write the metrics to `path` every `interval` seconds, in a background thread"""
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            with open(path + ".tmp", "w", encoding="utf8") as outfile:
+                outfile.write(METRICS.render())
+            os.replace(path + ".tmp", path)
+
+    thread = threading.Thread(target=dump, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
+
+
+def start(settings: dict) -> None:
+    """Start what is enabled in the [metrics] section of bot.toml"""
+    if settings.get("port"):
+        serve(settings["port"], settings.get("host", "127.0.0.1"), settings.get("profiler", False))
+        _logger.info("Metrics on port %d", settings["port"])
+    if settings.get("dump_file"):
+        dump_forever(settings["dump_file"], settings.get("dump_interval", 60))
@@ -1,110 +1,361 @@
+import hashlib
+import json
+import logging
 import os
-from dataclasses import asdict, dataclass
+import pickle
+import sys
+import threading
+from collections.abc import Iterable, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
 from typing import TYPE_CHECKING
 
 import toml
-from thefuzz import process as processfuzz
 
+from . import metrics
+from .fuzzy import FuzzyMatcher
+from .media import MEDIA_PATH, MediaInfo, read_media
+from .storage import JournalStore, SqliteStore
 from .utils import ANIM_RE
 
 if TYPE_CHECKING:
     from praw.reddit import Comment
 
+_logger = logging.getLogger("ImmaginiBot")
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class Image:
     url: str
     reddit_id: str | None
     animated: bool
 
 
-@dataclass(frozen=True)
+def _image_key(image: Image) -> tuple[str, str, bool]:
+    return image.url, image.reddit_id or "", image.animated
+
+
+@dataclass(frozen=True, slots=True, init=False)
 class ImageSet:
+    """Keywords and images are kept in sorted tuples, read as frozensets
+
+    A frozenset takes at least 216 bytes, a tuple 40 plus 8 for each item.
+    """
+
     id: str
-    keywords: frozenset[str]
-    images: frozenset[Image]
-    hidden_keywords: frozenset[str]
+    _keywords: tuple[str, ...]
+    _images: tuple[Image, ...]
+    _hidden_keywords: tuple[str, ...]
     hide: bool = False
 
+    def __init__(
+        self,
+        id: str,
+        keywords: Iterable[str],
+        images: Iterable[Image],
+        hidden_keywords: Iterable[str],
+        hide=False,
+    ):
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "_keywords", tuple(sorted(set(keywords))))
+        object.__setattr__(self, "_images", tuple(sorted(set(images), key=_image_key)))
+        object.__setattr__(self, "_hidden_keywords", tuple(sorted(set(hidden_keywords))))
+        object.__setattr__(self, "hide", hide)
+
+    @property
+    def keywords(self) -> frozenset[str]:
+        return frozenset(self._keywords)
+
+    @property
+    def images(self) -> frozenset[Image]:
+        return frozenset(self._images)
+
+    @property
+    def hidden_keywords(self) -> frozenset[str]:
+        return frozenset(self._hidden_keywords)
+
+
+class ImageDatabase:
+    """Image sets and the indexes derived from them, never modified once built
+
+    Given the `previous` database, unchanged sets are recognized by identity
+    and only the keywords of the changed ones are indexed again.
+    Keywords and URLs are interned, an image in several sets is one object.
+    The indexes read the tuples of the sets, not their frozenset views.
+    """
+
+    def __init__(
+        self,
+        image_sets: Iterable[ImageSet],
+        sources: Mapping[str, bytes] | None = None,
+        mtime=0,
+        previous: "ImageDatabase | None" = None,
+        media: Mapping[str, MediaInfo] | None = None,
+    ):
+        self.image_sets: Mapping[str, ImageSet] = MappingProxyType({s.id: s for s in image_sets})
+        # fingerprint of the toml definition of each set, to reuse the unchanged ones
+        self.sources: Mapping[str, bytes] = MappingProxyType(dict(sources or {}))
+        # resolved media the images were built with
+        self.media: Mapping[str, MediaInfo] = MappingProxyType(dict(media or {}))
+        self.mtime = mtime
+        if previous is None:
+            changed = set(self.image_sets)
+            keyword_sets: dict[str, set[str] | tuple[str, ...]] = {}
+            keyword_index: dict[str, tuple[tuple[Image, ...], tuple[Image, ...]]] = {}
+        else:
+            changed = {
+                key
+                for key in self.image_sets.keys() | previous.image_sets.keys()
+                if self.image_sets.get(key) is not previous.image_sets.get(key)
+            }
+            keyword_sets = dict(previous._keyword_sets)
+            keyword_index = dict(previous.keyword_index)
+        touched = set()
+        for key in changed:
+            for imageset in (previous.image_sets.get(key) if previous else None,) + (
+                self.image_sets.get(key),
+            ):
+                if imageset is None:
+                    continue
+                for keyword in imageset._keywords + imageset._hidden_keywords:
+                    if keyword not in touched:
+                        keyword_sets[keyword] = set(keyword_sets.get(keyword, ()))
+                        touched.add(keyword)
+                    keyword_sets[keyword].discard(key)
+            if key in self.image_sets:
+                imageset = self.image_sets[key]
+                for keyword in imageset._keywords + imageset._hidden_keywords:
+                    keyword_sets[keyword].add(key)
+        for keyword in touched:
+            if keyword_sets[keyword]:
+                # a set takes four times the memory of a short tuple
+                keyword_sets[keyword] = tuple(sorted(keyword_sets[keyword]))
+                keyword_index[keyword] = _index_entry(
+                    self.image_sets[k] for k in keyword_sets[keyword]
+                )
+            else:
+                del keyword_sets[keyword]
+                keyword_index.pop(keyword, None)
+        # keyword -> ids of its sets
+        self._keyword_sets: dict[str, tuple[str, ...]] = keyword_sets  # type: ignore[assignment]
+        # keyword -> (static images, animated images), hidden keywords included
+        self.keyword_index: Mapping[str, tuple[tuple[Image, ...], tuple[Image, ...]]] = (
+            MappingProxyType(keyword_index)
+        )
+        keywords = [k for s in self.image_sets.values() for k in s._keywords]
+        if previous is not None and previous._keywords == keywords:
+            self.fuzzy_matcher = previous.fuzzy_matcher
+        else:
+            self.fuzzy_matcher = FuzzyMatcher(keywords)
+        self._keywords = keywords
+
+    # mappingproxy cannot be pickled
+    _PROXIES = ("image_sets", "sources", "media", "keyword_index")
 
-IMAGE_SETS: set[ImageSet] = set()
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in self._PROXIES:
+            state[key] = dict(state[key])
+        return state
+
+    def __setstate__(self, state):
+        for key in self._PROXIES:
+            state[key] = MappingProxyType(state[key])
+        self.__dict__.update(state)
+
+    @classmethod
+    def from_toml(
+        cls,
+        path: str,
+        previous: "ImageDatabase | None" = None,
+        cache=True,
+        media_path: str | None = None,
+    ) -> "ImageDatabase":
+        """Parse `path`, reusing the sets of `previous` not changed since
+
+        With `cache` the parsed database is also stored in `path`.cache and
+        loaded from there while the content of `path` stays the same.
+        The images without a reddit_id take it from `media_path`, written by
+        `immaginibot.media`, if they were resolved.
+        """
+        mtime = _mtime(path, media_path)
+        with open(path, "rb") as infile:
+            content = infile.read()
+        hasher = hashlib.sha256(content)
+        media: dict[str, MediaInfo] = {}
+        if media_path is not None and os.path.exists(media_path):
+            with open(media_path, "rb") as infile:
+                hasher.update(infile.read())
+            media = read_media(media_path)
+        digest = hasher.hexdigest()
+        if cache and previous is None:
+            database = _read_cache(path + ".cache", digest)
+            if database is not None:
+                database.mtime = mtime
+                return database
+        newdefinitions = toml.loads(content.decode("utf8"))
+        if previous is not None and previous.media != media:
+            # every set may take new ids
+            reusable: Mapping[str, bytes] = {}
+        else:
+            reusable = previous.sources if previous is not None else {}
+        image_sets = []
+        sources = {}
+        # one Image for each distinct image
+        shared: dict[tuple[str, str | None, bool], Image] = {}
+        for key, value in newdefinitions.items():
+            sources[key] = _fingerprint(value)
+            if reusable.get(key) == sources[key]:
+                image_sets.append(previous.image_sets[key])
+            else:
+                image_sets.append(_toml_make_imageset(key, value, media, shared))
+        database = cls(image_sets, sources, mtime, previous, media)
+        if cache:
+            _write_cache(path + ".cache", digest, database)
+        return database
+
+    def get_images(self, word: str, animated=None) -> list[Image] | None:
+        """Get all images for `word`, if possibile match also `animated`"""
+        entry = self.keyword_index.get(word)
+        if not entry:
+            return None
+        static, anim = entry
+        if animated is not None:
+            a_images_set = anim if animated else static
+            if a_images_set:
+                return list(a_images_set)
+        return list(static + anim)
+
+
+# bump when ImageDatabase, ImageSet, Image or FuzzyMatcher change
+CACHE_VERSION = 4
+
+
+def _mtime(path: str, media_path: str | None) -> int:
+    """Last change of images.toml or of the resolved media"""
+    mtime = os.stat(path).st_mtime_ns
+    if media_path is not None:
+        try:
+            mtime = max(mtime, os.stat(media_path).st_mtime_ns)
+        except FileNotFoundError:
+            pass
+    return mtime
+
+
+def _read_cache(path: str, digest: str) -> ImageDatabase | None:
+    """The cached database, if it was built from a source with `digest`"""
+    try:
+        with open(path, "rb") as infile:
+            version, cached_digest, database = pickle.load(infile)
+    except FileNotFoundError:
+        return None
+    except Exception as expt:
+        _logger.warning("Ignoring %s: %s", path, expt)
+        return None
+    if version != CACHE_VERSION or cached_digest != digest:
+        return None
+    return database
+
+
+def _write_cache(path: str, digest: str, database: ImageDatabase) -> None:
+    # several workers may write it at the same time
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as outfile:
+            pickle.dump((CACHE_VERSION, digest, database), outfile, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as expt:
+        _logger.warning("Cannot write %s: %s", path, expt)
+
+
+def _index_entry(image_sets: Iterable[ImageSet]) -> tuple[tuple[Image, ...], tuple[Image, ...]]:
+    static: list[Image] = []
+    anim: list[Image] = []
+    for imageset in image_sets:
+        for image in imageset._images:
+            (anim if image.animated else static).append(image)
+    return tuple(static), tuple(anim)
 
 
 def get_fuzzy_word(word: str) -> str | None:
-    keywords = [i for s in IMAGE_SETS for i in s.keywords]
-    keyword, score = processfuzz.extractOne(word, keywords)  # type: ignore
-    if score > 93:
-        return keyword
-    return None
+    return REGISTRY.images.fuzzy_matcher.match(word)
 
 
 def get_images(word: str, animated=None) -> list[Image] | None:
     """Get all images for `word`, if possibile match also `animated`"""
-    all_images_sets = [s for s in IMAGE_SETS for i in s.keywords if i == word]
-    if not all_images_sets:
-        return None
-    if animated is not None:
-        a_images_set = [i for s in all_images_sets for i in s.images if i.animated == animated]
-        if a_images_set:
-            return a_images_set
-    return [i for s in all_images_sets for i in s.images]
+    return REGISTRY.images.get_images(word, animated)
+
+
+def _fingerprint(value) -> bytes:
+    """Digest of a toml definition, kept instead of the definition"""
+    text = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode("utf8"), digest_size=16).digest()
 
 
 def _toml_get_words(key: str, item, plural: str, singular: str) -> list[str]:
     rvalue = item.get(plural, None)
     if rvalue:
         if isinstance(rvalue, list):
-            return [r.lower() for r in rvalue]
+            return [sys.intern(r.lower()) for r in rvalue]
         else:
             raise TypeError(f"{key}.{plural} not handled")
     else:
         rvalue = item.get(singular, None)
         if rvalue:
             if isinstance(rvalue, str):
-                return [rvalue.lower()]
+                return [sys.intern(rvalue.lower())]
             else:
                 raise TypeError(f"{key}.{singular} not handled")
     return []
 
 
-def _toml_make_image(item) -> Image:
+def _toml_make_image(
+    item, media: Mapping[str, MediaInfo], shared: dict[tuple[str, str | None, bool], Image]
+) -> Image:
     reddit_id = None
-    if isinstance(item, list):
-        url = item[0]
-        reddit_id = item[1]
+    if isinstance(item, list) and len(item) == 2 and isinstance(item[0], str):
+        url, reddit_id = item
     elif isinstance(item, str):
         url = item
     else:
         raise TypeError(f"Image not handled {item}")
-    animated = ANIM_RE.search(url) is not None
-    return Image(url, reddit_id, animated)
-
-
-def load_images_from_toml() -> None:
-    with open(os.path.join("config", "images.toml")) as infile:
-        newdefinitions = toml.load(infile)
-    for key, value in newdefinitions.items():
-        # keywords
-        keywords = frozenset([key.lower()] + _toml_get_words(key, value, "aliases", "alias"))
-        # hidden_keywords
-        hidden_keywords = frozenset(_toml_get_words(key, value, "hiddens", "hidden"))
-        # hide
-        hide = bool(value.get("hide", False))
-        # image
-        rvalue = value.get("image", None)
+    info = media.get(url)
+    if info is None:
+        animated = ANIM_RE.search(url) is not None
+    else:
+        reddit_id = reddit_id or info.reddit_id
+        animated = info.animated
+    image = shared.get((url, reddit_id, animated))
+    if image is None:
+        image = Image(sys.intern(url), reddit_id, animated)
+        shared[(image.url, reddit_id, animated)] = image
+    return image
+
+
+def _toml_make_imageset(
+    key: str,
+    value,
+    media: Mapping[str, MediaInfo],
+    shared: dict[tuple[str, str | None, bool], Image],
+) -> ImageSet:
+    # keywords
+    keywords = [sys.intern(key.lower())] + _toml_get_words(key, value, "aliases", "alias")
+    # hidden_keywords
+    hidden_keywords = _toml_get_words(key, value, "hiddens", "hidden")
+    # hide
+    hide = bool(value.get("hide", False))
+    # image
+    rvalue = value.get("image", None)
+    if rvalue:
+        images = [_toml_make_image(rvalue, media, shared)]
+    else:
+        rvalue = value.get("images", None)
         if rvalue:
-            images = frozenset([_toml_make_image(rvalue)])
+            images = [_toml_make_image(i, media, shared) for i in rvalue]
         else:
-            rvalue = value.get("images", None)
-            if rvalue:
-                images = frozenset([_toml_make_image(i) for i in rvalue])
-            else:
-                raise TypeError("No images!")
-        # DONE!
-        IMAGE_SETS.add(ImageSet(key, keywords, images, hidden_keywords, hide))
-
-
-load_images_from_toml()
+            raise TypeError("No images!")
+    # DONE!
+    return ImageSet(sys.intern(key), keywords, images, hidden_keywords, hide)
 
 
 @dataclass
@@ -112,67 +363,137 @@ class BotComment:
     id: str
     parent_id: str
     parent_author: str
-    deleted = False
-    richtext = False
+    deleted: bool = False
+    richtext: bool = False
 
     @staticmethod
     def get_by_parent(parent_id: str) -> "BotComment | None":
         """Find all active comments by parent_id and parent_author"""
-        if parent_id not in BOTCOMMENTS:
-            return None
-        e = BOTCOMMENTS[parent_id]
-        if e.deleted:
+        e = REGISTRY.status.get(parent_id)
+        if not e or e.deleted:
             return None
         return e
 
     @staticmethod
-    def save(e: "BotComment | None" = None) -> None:
-        if e:
-            BOTCOMMENTS[e.parent_id] = e
-        save_status_to_toml()
-
-    @classmethod
-    def from_reddit(cls, comment: "Comment") -> "BotComment":
-        parent = comment.parent()
-        return BotComment(
-            comment.id, parent.id, parent.author.name if parent.author else "[deleted]"
-        )
-
-
-BOTCOMMENTS: dict[str, BotComment] = {}
-
-
-def load_status_from_toml() -> None:
-    try:
-        with open(os.path.join("config", "status.toml")) as infile:
-            tcomments = toml.load(infile)
-        for c in tcomments["comments"]:
-            e = BotComment(**c)
-            BOTCOMMENTS[e.parent_id] = e
-    except FileNotFoundError:
-        return
-
+    def get_by_id(comment_id: str) -> "BotComment | None":
+        """Find a comment of the bot by its id"""
+        return REGISTRY.status.get_by_id(comment_id)
 
-def save_status_to_toml() -> None:
-    tstatus = {"comments_old": []}
-    try:
-        with open(os.path.join("config", "status.toml")) as infile:
-            tstatus.update(toml.load(infile))
-    except FileNotFoundError:
-        return
-    tstatus["comments"] = sorted(
-        [asdict(c) for c in BOTCOMMENTS.values()], key=lambda a: a["id"], reverse=True
-    )
-    tstatus["comments_old"] = tstatus["comments"][100:] + tstatus["comments_old"]
-    tstatus["comments"] = tstatus["comments"][0:100]
-    with open(os.path.join("config", "status.toml"), "w") as outfile:
-        toml.dump(tstatus, outfile)
+    @staticmethod
+    def save(e: "BotComment") -> None:
+        with metrics.STATUS_SAVE_SECONDS.time():
+            REGISTRY.status.save(e)
 
+    @classmethod
+    def from_parent(cls, parent: "Comment", reply_id: str) -> "BotComment":
+        """Build from the comment the bot replied to, without any request to Reddit"""
+        return cls(reply_id, parent.id, parent.author.name if parent.author else "[deleted]")
+
+
+IMAGES_PATH = os.path.join("config", "images.toml")
+STATUS_JOURNAL = os.path.join("config", "status.jsonl")
+STATUS_DB = os.path.join("config", "status.sqlite3")
+
+
+def open_status_store() -> JournalStore | SqliteStore:
+    """SQLite if the database was created, the journal otherwise"""
+    if os.path.exists(STATUS_DB):
+        return SqliteStore(STATUS_DB, BotComment)
+    return JournalStore(STATUS_JOURNAL, BotComment)
+
+
+def switch_to_sqlite() -> int:
+    """Copy the journal to a new SQLite database, used from then on
+
+    Return the number of comments copied."""
+    if os.path.exists(STATUS_DB):
+        raise FileExistsError(STATUS_DB)
+    journal = REGISTRY.status
+    SqliteStore(STATUS_DB, BotComment).save_many(journal.values())
+    journal.close()
+    REGISTRY.status = open_status_store()
+    return len(journal)
+
+
+class Registry:
+    """Image database and reply store, loaded on first use
+
+    Importing this module reads nothing: the bot and the export entry points
+    call `load`, everything else gets loaded when accessed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._images: ImageDatabase | None = None
+        self._status: JournalStore | SqliteStore | None = None
+        # mtime of the last images.toml that could not be loaded
+        self._failed_mtime = None
+
+    def load(self) -> None:
+        """Load images and replies now"""
+        _ = self.images, self.status
+
+    @property
+    def images(self) -> ImageDatabase:
+        if self._images is None:
+            with self._lock:
+                if self._images is None:
+                    self._images = ImageDatabase.from_toml(IMAGES_PATH, media_path=MEDIA_PATH)
+        return self._images
+
+    @images.setter
+    def images(self, database: ImageDatabase) -> None:
+        self._images = database
+
+    @property
+    def status(self) -> JournalStore | SqliteStore:
+        if self._status is None:
+            with self._lock:
+                if self._status is None:
+                    self._status = self._load_status()
+        return self._status
+
+    @status.setter
+    def status(self, store: JournalStore | SqliteStore) -> None:
+        self._status = store
 
-load_status_from_toml()
+    @staticmethod
+    def _load_status() -> JournalStore | SqliteStore:
+        """Load the store, migrating the old status.toml the first time"""
+        store = open_status_store()
+        if isinstance(store, JournalStore) and store.migrate_from_toml(
+            os.path.join("config", "status.toml")
+        ):
+            return store
+        store.load()
+        return store
+
+    def reload_images(self) -> bool:
+        """Load images.toml again if it was modified, keep the current database on errors"""
+        try:
+            mtime = _mtime(IMAGES_PATH, MEDIA_PATH)
+        except OSError:
+            # most likely being replaced, try again later
+            return False
+        current = self.images
+        if mtime in (current.mtime, self._failed_mtime):
+            return False
+        try:
+            database = ImageDatabase.from_toml(IMAGES_PATH, current, media_path=MEDIA_PATH)
+        except (OSError, TypeError, ValueError, AttributeError, LookupError) as expt:
+            self._failed_mtime = mtime
+            _logger.error("Invalid %s, keeping the old images: %s", IMAGES_PATH, expt)
+            return False
+        self.images = database
+        _logger.info("Reloaded %s: %d sets", IMAGES_PATH, len(database.image_sets))
+        return True
+
+
+REGISTRY = Registry()
 
 if __name__ == "__main__":
     from pprint import pprint
 
-    pprint(IMAGE_SETS)
-    pprint(BOTCOMMENTS.values())
+    REGISTRY.load()
+    pprint(list(REGISTRY.images.image_sets.values()))
+    pprint(list(REGISTRY.status.values()))
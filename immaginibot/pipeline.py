@@ -0,0 +1,180 @@
+"""Send the requests to Reddit from background threads, most important first"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections.abc import Callable, Mapping
+from enum import IntEnum
+
+from prawcore.exceptions import PrawcoreException
+
+from . import metrics
+
+
+class Priority(IntEnum):
+    REPLY = 0
+    DELETE = 1
+    EDIT = 2
+    MARK_READ = 3
+    FORWARD = 4
+    EXPORT = 5
+
+
+QUEUE_DEPTH = metrics.METRICS.gauge(
+    "immaginibot_scheduler_queue_depth", "Requests waiting in the scheduler, by priority"
+)
+DEFERRED = metrics.METRICS.counter(
+    "immaginibot_scheduler_deferred_total", "Requests put back for the rate limit, by priority"
+)
+RATELIMIT_REMAINING = metrics.METRICS.gauge(
+    "immaginibot_ratelimit_remaining", "Requests left in the Reddit rate limit window"
+)
+
+# (priority, sequence, key, function, args), None as function stops a worker
+_Job = tuple[int, int, str, Callable[..., object] | None, tuple]
+
+
+class RequestScheduler:
+    """Bounded priority queue of requests, run by a pool of worker threads
+
+    Submitting a reply blocks while `queue_size` replies are waiting, so a
+    slow Reddit slows down the comment stream instead of piling up work; the
+    other jobs follow from a reply or a message and never block. A job failing with a Reddit
+    error is retried with an increasing delay.
+
+    While the rate limit window is running out, `reserve` requests are kept
+    for each priority above the one of a job: a job that does not fit is put
+    back in the queue until the window resets or something more important
+    arrives. Replies are never deferred.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        limits: Callable[[], Mapping[str, object]] | None = None,
+        workers=4,
+        queue_size=50,
+        retries=3,
+        retry_delay=5.0,
+        reserve=10,
+    ):
+        self._logger = logger
+        self._limits = limits
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._reserve = reserve
+        self._queue: queue.PriorityQueue[_Job] = queue.PriorityQueue()
+        # bounds the replies, deferred jobs must always fit back in the queue
+        self._slots = threading.Semaphore(queue_size)
+        self._sequence = itertools.count()
+        self._pending: set[str] = set()
+        self._depth = dict.fromkeys(Priority, 0)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closing = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f"request-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def pending(self, key: str) -> bool:
+        """True if a job for `key` is queued or running"""
+        with self._lock:
+            return key in self._pending
+
+    def __len__(self) -> int:
+        return sum(self._depth.values())
+
+    def depth(self) -> dict[Priority, int]:
+        """Jobs queued or running, by priority"""
+        with self._lock:
+            return dict(self._depth)
+
+    def submit(self, key: str, priority: Priority, func: Callable[..., object], *args) -> bool:
+        """Queue `func(*args)`, unless a job for `key` is already pending"""
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            self._update_depth(priority, 1)
+            # a deferred job may be waiting for this
+            self._wakeup.notify_all()
+        if priority == Priority.REPLY:
+            self._slots.acquire()
+        self._queue.put((priority, next(self._sequence), key, func, args))
+        return True
+
+    def _update_depth(self, priority: Priority, change: int) -> None:
+        self._depth[priority] += change
+        QUEUE_DEPTH.set(self._depth[priority], priority=priority.name.lower())
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            priority, _, key, func, args = job
+            if func is None:
+                self._queue.task_done()
+                return
+            wait = self._wait_for_budget(Priority(priority))
+            if wait:
+                DEFERRED.inc(priority=Priority(priority).name.lower())
+                self._logger.debug("Deferring %s for %.0fs", key, wait)
+                self._queue.put(job)
+                self._queue.task_done()
+                with self._lock:
+                    self._wakeup.wait(wait)
+                continue
+            try:
+                self._run(key, func, args)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                    self._update_depth(Priority(priority), -1)
+                if priority == Priority.REPLY:
+                    self._slots.release()
+                self._queue.task_done()
+
+    def _wait_for_budget(self, priority: Priority) -> float:
+        """Seconds to wait before a job of `priority` fits in the rate limit, 0 if it does"""
+        if self._limits is None or priority == Priority.REPLY or self._closing:
+            return 0
+        limits = self._limits()
+        remaining, reset = limits.get("remaining"), limits.get("reset_timestamp")
+        if remaining is None or reset is None:
+            # no request made yet
+            return 0
+        RATELIMIT_REMAINING.set(float(remaining))
+        if float(remaining) > self._reserve * priority:
+            return 0
+        return max(float(reset) - time.time(), 1.0)
+
+    def _run(self, key: str, func: Callable[..., object], args: tuple) -> None:
+        for attempt in range(self._retries + 1):
+            try:
+                func(*args)
+                return
+            except PrawcoreException as prawexcept:
+                if attempt == self._retries:
+                    self._logger.error("Request %s failed: %s", key, prawexcept)
+                    return
+                delay = self._retry_delay * 2**attempt
+                self._logger.debug("Request %s failed, retry in %.0fs: %s", key, delay, prawexcept)
+                time.sleep(delay)
+            except Exception as expt:
+                self._logger.exception(expt)
+                return
+
+    def close(self) -> None:
+        """Send what is left in the queue, ignoring the rate limit, and stop the workers"""
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify_all()
+        for _ in self._threads:
+            # after every job
+            self._queue.put((len(Priority), next(self._sequence), "", None, ()))
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,440 @@
+"""Replay recorded or synthetic comments through the bot, without Reddit
+
+    python -m immaginibot.replay --config config [--input stream.jsonl]
+
+Each line of the input is a JSON object: `{"kind": "comment", "id", "body",
+"author"}` or `{"kind": "message", "id", "subject", "body", "author"}`.
+Without an input a synthetic stream is generated from the images database.
+The bot runs in a temporary copy of the config directory, the replies are
+captured and the time spent in each stage is reported.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import string
+import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+
+import praw
+from prawcore.exceptions import RequestException
+
+from . import bot as botmodule
+from . import metrics, models
+from .fuzzy import FuzzyMatcher
+from .utils import load_settings
+
+
+class FakeRedditor:
+    def __init__(self, reddit: "FakeReddit", name: str):
+        self._reddit = reddit
+        self.name = name
+
+    def __eq__(self, other) -> bool:
+        return str(self).lower() == str(other).lower()
+
+    def __hash__(self) -> int:
+        return hash(self.name.lower())
+
+    def __str__(self) -> str:
+        return self.name
+
+    def message(self, subject: str, message: str) -> None:
+        self._reddit.record("message", to=self.name, subject=subject, body=message)
+
+    def moderated(self) -> list["FakeSubreddit"]:
+        return [self._reddit.mainsubreddit]
+
+    def multireddits(self) -> list["FakeSubreddit"]:
+        return [self._reddit.multireddit]
+
+
+class FakeComment(praw.models.Comment):
+    """A comment never fetched: `isinstance` works, every attribute is local"""
+
+    def __init__(self, reddit: "FakeReddit", id: str, body: str, author: str | None):
+        self.__dict__.update(
+            _reddit=reddit,
+            _fetched=True,
+            _replies=[],
+            id=id,
+            body=body,
+            author=FakeRedditor(reddit, author) if author else None,
+            archived=False,
+            permalink=f"/r/replay/comments/replay/_/{id}/",
+            context=f"/r/replay/comments/replay/_/{id}/?context=3",
+            subject="username mention",
+            created_utc=time.time(),
+        )
+
+    @property
+    def fullname(self) -> str:
+        return f"t1_{self.id}"
+
+    def reply(self, body: str) -> "FakeComment":
+        return self._reddit.new_comment(body, self._reddit.username, parent=self)
+
+    def delete(self) -> None:
+        self._reddit.record("delete", id=self.id)
+
+    def mark_read(self) -> None:
+        self._reddit.record("mark_read", id=self.id)
+
+
+class FakeMessage:
+    def __init__(self, reddit: "FakeReddit", id: str, subject: str, body: str, author: str):
+        self._reddit = reddit
+        self.id = id
+        self.fullname = f"t4_{id}"
+        self.subject = subject
+        self.body = body
+        self.author = FakeRedditor(reddit, author) if author else None
+        self.created_utc = time.time()
+
+    def mark_read(self) -> None:
+        self._reddit.record("mark_read", id=self.id)
+
+    def reply(self, body: str) -> None:
+        self._reddit.record("message_reply", id=self.id, body=body)
+
+
+class _Stream:
+    def __init__(self, comments: Callable[..., Iterator]):
+        self.comments = comments
+
+
+class FakeSubreddit:
+    def __init__(self, reddit: "FakeReddit", name: str, moderators: list[str]):
+        self._reddit = reddit
+        self.display_name = name
+        self._moderators = [FakeRedditor(reddit, m) for m in moderators]
+        self.stream = _Stream(reddit.comment_stream)
+
+    def moderator(self) -> list[FakeRedditor]:
+        return list(self._moderators)
+
+    def hot(self) -> list:
+        return []
+
+
+class _User:
+    def __init__(self, reddit: "FakeReddit"):
+        self._reddit = reddit
+
+    def me(self) -> FakeRedditor:
+        return FakeRedditor(self._reddit, self._reddit.username)
+
+
+class _Inbox:
+    def __init__(self, reddit: "FakeReddit"):
+        self._reddit = reddit
+
+    def stream(self, pause_after=None) -> Iterator:
+        _ = pause_after
+        self._reddit.maybe_fail("inbox", opening=True)
+        while True:
+            while self._reddit.unread:
+                self._reddit.maybe_fail("inbox")
+                yield self._reddit.unread.pop(0)
+            yield None
+
+    def mark_read(self, items: list) -> None:
+        self._reddit.record("mark_read", ids=[item.id for item in items])
+
+
+class _Auth:
+    def __init__(self, reddit: "FakeReddit"):
+        self._reddit = reddit
+
+    @property
+    def limits(self) -> dict:
+        # never rate limited
+        return {"remaining": None, "reset_timestamp": None, "used": None}
+
+
+class FakeReddit:
+    """Enough of `praw.Reddit` for ImmaginiBot, fed by a list of records
+
+    `latency` seconds are spent on every write, like a round trip to Reddit.
+    Each item read from a stream fails with probability `failure_rate`, then
+    the next `outage` attempts to open that stream fail as well.
+    """
+
+    def __init__(
+        self,
+        records: Iterable[dict],
+        username="immaginibot",
+        moderator="mod",
+        latency=0.0,
+        failure_rate=0.0,
+        outage=0,
+        seed=0,
+    ):
+        self.username = username
+        self.latency = latency
+        self.records = list(records)
+        self.failure_rate = failure_rate
+        self.outage = outage
+        self._rnd = random.Random(seed)
+        # stream -> failing attempts left
+        self._outages: dict[str, int] = {}
+        # records already read by a comment stream
+        self.position = 0
+        self.exhausted = False
+        self.unread: list = []
+        self.actions: list[dict] = []
+        self.comments: dict[str, FakeComment] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self.user = _User(self)
+        self.inbox = _Inbox(self)
+        self.auth = _Auth(self)
+        self.mainsubreddit = FakeSubreddit(self, "replay", [moderator])
+        self.multireddit = FakeSubreddit(self, "replay_multi", [])
+
+    def record(self, action: str, **kwargs) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.actions.append(dict(action=action, **kwargs))
+
+    def new_comment(self, body: str, author: str, parent: FakeComment) -> FakeComment:
+        with self._lock:
+            comment = FakeComment(self, f"z{next(self._ids):06d}", body, author)
+            self.comments[comment.id] = comment
+        self.record("reply", id=comment.id, parent_id=parent.id, body=body)
+        return comment
+
+    def comment(self, id: str) -> FakeComment:
+        return self.comments.get(id) or FakeComment(self, id, "", "someone")
+
+    def post(self, path: str, data: dict) -> dict:
+        self.record("post", path=path, data=data)
+        return {}
+
+    def maybe_fail(self, stream: str, opening=False) -> None:
+        """Raise like a connection error, if it is the time"""
+        if opening:
+            if self._outages.get(stream, 0) <= 0:
+                return
+            self._outages[stream] -= 1
+        elif self._rnd.random() >= self.failure_rate:
+            return
+        else:
+            self._outages[stream] = self.outage
+        self.record("failure", stream=stream)
+        raise RequestException(ConnectionError("injected failure"), (), {})
+
+    def comment_stream(
+        self, pause_after=None, batch=100, replayed=100
+    ) -> Iterator[FakeComment | None]:
+        """The comments of the records, `None` every `batch` like a paused stream
+
+        A new stream starts from the last `replayed` comments already read,
+        like Reddit does."""
+        _ = pause_after
+        self.maybe_fail("comments", opening=True)
+        start = self.position
+        while start > 0 and replayed > 0:
+            start -= 1
+            replayed -= self.records[start].get("kind", "comment") == "comment"
+        count = 0
+        for idx in range(start, len(self.records)):
+            item = self.records[idx]
+            if item.get("kind", "comment") == "message":
+                if idx >= self.position:
+                    self.unread.append(
+                        FakeMessage(self, item["id"], item["subject"], item["body"], item["author"])
+                    )
+                    self.position = idx + 1
+                continue
+            self.maybe_fail("comments")
+            comment = FakeComment(self, item["id"], item["body"], item.get("author", "someone"))
+            self.comments[comment.id] = comment
+            self.position = max(self.position, idx + 1)
+            yield comment
+            count += 1
+            if count % batch == 0:
+                yield None
+        self.exhausted = True
+        yield None
+
+
+class _Done:
+    """Stops the bot once the stream is over and the inbox is empty"""
+
+    def __init__(self, reddit: FakeReddit):
+        self._reddit = reddit
+
+    @property
+    def received_kill(self) -> bool:
+        return self._reddit.exhausted and not self._reddit.unread
+
+
+def synthetic_records(count: int, seed=0) -> list[dict]:
+    """Comments using the known keywords, typos and unknown words, a few messages"""
+    rnd = random.Random(seed)
+    keywords = sorted(k for s in models.REGISTRY.images.image_sets.values() for k in s.keywords)
+    words = ["ciao", "come", "stai", "questo", "commento", "davvero", "perché", "boh"]
+    records: list[dict] = []
+    for idx in range(count):
+        text = rnd.choices(words, k=rnd.randint(3, 40))
+        roll = rnd.random()
+        if roll < 0.05 and keywords:
+            text.insert(rnd.randrange(len(text)), f"{rnd.choice(keywords)}.jpg")
+        elif roll < 0.08 and keywords:
+            keyword = rnd.choice(keywords)
+            pos = rnd.randrange(len(keyword))
+            typo = keyword[:pos] + rnd.choice(string.ascii_lowercase) + keyword[pos + 1 :]
+            text.insert(rnd.randrange(len(text)), f"{typo}.gif")
+        elif roll < 0.12:
+            text.append(rnd.choice(["file.png", "screenshot.jpg"]))
+        records.append({"kind": "comment", "id": f"c{idx:06d}", "body": " ".join(text)})
+        if rnd.random() < 0.01:
+            records.append(
+                {
+                    "kind": "message",
+                    "id": f"m{idx:06d}",
+                    "subject": "Info",
+                    "body": "ciao bot",
+                    "author": "someone",
+                }
+            )
+    return records
+
+
+_MISSING = object()
+
+
+class StageTimer:
+    """Time the calls of some functions, put back by `restore`"""
+
+    def __init__(self):
+        self.timings: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+        self._patched: list[tuple[object, str, object]] = []
+
+    def wrap(self, owner, name: str, stage: str) -> None:
+        """Replace `owner.name` (module, class or instance attribute) with a timed copy"""
+        saved = vars(owner).get(name, _MISSING)
+        static = isinstance(saved, staticmethod)
+        func = saved.__func__ if static else getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.timings.setdefault(stage, []).append(elapsed)
+
+        self._patched.append((owner, name, saved))
+        setattr(owner, name, staticmethod(timed) if static else timed)
+
+    def restore(self) -> None:
+        for owner, name, saved in reversed(self._patched):
+            if saved is _MISSING:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, saved)
+        self._patched.clear()
+
+    def report(self) -> str:
+        lines = [f"{'stage':<16} {'calls':>8} {'total s':>10} {'mean us':>10} {'p99 us':>10}"]
+        for stage, timings in self.timings.items():
+            values = sorted(timings)
+            p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+            lines.append(
+                f"{stage:<16} {len(values):8d} {sum(values):10.3f} "
+                f"{sum(values) / len(values) * 1e6:10.1f} {p99 * 1e6:10.1f}"
+            )
+        return "\n".join(lines)
+
+
+def replay(bot: "botmodule.ImmaginiBot", reddit: FakeReddit, timer: StageTimer | None = None):
+    """Run the whole stream through `bot`, return the elapsed seconds"""
+    timer = timer or StageTimer()
+    timer.wrap(bot, "find_matches", "find_matches")
+    timer.wrap(bot, "make_comment", "make_comment")
+    timer.wrap(botmodule.WordCache, "get", "word cache")
+    timer.wrap(models.ImageDatabase, "get_images", "get_images")
+    timer.wrap(FuzzyMatcher, "match", "get_fuzzy_word")
+    timer.wrap(models.BotComment, "save", "status save")
+    start = time.perf_counter()
+    try:
+        bot.stream_all(sighandler=_Done(reddit))
+    finally:
+        timer.restore()
+    return time.perf_counter() - start
+
+
+def main():
+    """Replay a stream and print throughput and stage timings"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--config", default="config", help="directory with the bot config")
+    parser.add_argument("--input", help="JSON lines of comments and messages")
+    parser.add_argument("--count", type=int, default=10000, help="synthetic comments")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds for each write")
+    parser.add_argument("--output", help="write the captured actions here, as JSON lines")
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="chance of an error for each item"
+    )
+    parser.add_argument("--outage", type=int, default=0, help="failed attempts after an error")
+    parser.add_argument("--log-level", default="WARNING", help="level of the bot logger")
+    args = parser.parse_args()
+    source = os.path.abspath(args.config)
+    records: list[dict] = []
+    if args.input:
+        with open(args.input, encoding="utf8") as infile:
+            records = [json.loads(line) for line in infile if line.strip()]
+    output = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # status and seen files stay in the copy
+        shutil.copytree(
+            source,
+            os.path.join(tmpdir, "config"),
+            ignore=shutil.ignore_patterns("status.*", "seen.*"),
+        )
+        os.chdir(tmpdir)
+        try:
+            if not records:
+                records = synthetic_records(args.count)
+            reddit = FakeReddit(
+                records, latency=args.latency, failure_rate=args.failure_rate, outage=args.outage
+            )
+            settings = load_settings()
+            # the backoff in milliseconds instead of seconds
+            settings["streams"] = {"base_delay": 0.01, "max_delay": 0.2, "cooldown": 0.5}
+            bot = botmodule.ImmaginiBot(reddit, settings)
+            bot._logger.setLevel(args.log_level)
+            timer = StageTimer()
+            elapsed = replay(bot, reddit, timer)
+        finally:
+            os.chdir(cwd)
+    comments = sum(1 for r in records if r.get("kind", "comment") == "comment")
+    replies = sum(1 for a in reddit.actions if a["action"] == "reply")
+    print(f"{comments} comments, {replies} replies in {elapsed:.2f}s")
+    print(f"{comments / elapsed:.1f} comments/s")
+    print(timer.report())
+    failures = sum(1 for a in reddit.actions if a["action"] == "failure")
+    if failures:
+        print(f"{failures} injected failures")
+        for stream in ("comments", "inbox"):
+            print(
+                f"{stream}: {metrics.STREAM_FAILURES.value(stream=stream):.0f} errors, "
+                f"{metrics.STREAM_OUTAGE_SECONDS.count(stream=stream)} outages"
+            )
+    if output:
+        with open(output, "w", encoding="utf8") as outfile:
+            for action in reddit.actions:
+                outfile.write(json.dumps(action) + "\n")
+
+
+if __name__ == "__main__":
+    main()
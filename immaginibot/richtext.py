@@ -0,0 +1,132 @@
+"""Richtext replies from the body.json and force.json templates"""
+
+import copy
+import json
+import re
+
+# stands for a value while the template is serialized
+_MARKER = "\x00{}\x00"
+# a marker as a whole JSON value, or inside a string
+_SLOT_RE = re.compile(r'"\\u0000(\w+)\\u0000"|\\u0000(\w+)\\u0000')
+
+
+def _check(condition: bool, path: str, what: str) -> None:
+    if not condition:
+        raise ValueError(f"{path}: {what}")
+
+
+def check_template(body, force, body_path="body.json", force_path="force.json") -> None:
+    """Raise ValueError if the templates are not shaped like the examples"""
+    _check(isinstance(body, dict), body_path, "not an object")
+    document = body.get("document")
+    _check(
+        isinstance(document, list) and len(document) >= 3,
+        body_path,
+        "document must have the link, the image and the footer",
+    )
+    link_par, image, footer = document[:3]
+    _check(
+        isinstance(link_par, dict)
+        and isinstance(link_par.get("c"), list)
+        and link_par["c"]
+        and isinstance(link_par["c"][0], dict),
+        body_path,
+        "document[0] must be a paragraph with the link",
+    )
+    link = link_par["c"][0]
+    _check("t" in link and "u" in link, body_path, "document[0].c[0] must have t and u")
+    formats = link.get("f")
+    _check(
+        isinstance(formats, list)
+        and formats
+        and isinstance(formats[0], list)
+        and len(formats[0]) == 3,
+        body_path,
+        "document[0].c[0].f[0] must be [style, start, length]",
+    )
+    _check(isinstance(image, dict) and "id" in image, body_path, "document[1] must have the id")
+    _check(
+        isinstance(footer, dict)
+        and isinstance(footer.get("c"), list)
+        and all(isinstance(e, dict) for e in footer["c"]),
+        body_path,
+        "document[2] must be a paragraph",
+    )
+    for element in footer["c"]:
+        if "u" in element:
+            try:
+                element["u"].format(username="", comment_id="")
+            except (KeyError, IndexError, ValueError, AttributeError) as expt:
+                raise ValueError(f"{body_path}: invalid link {element['u']!r}: {expt}") from None
+    _check(isinstance(force, dict), force_path, "must be a single paragraph object")
+
+
+class RichtextTemplate:
+    """The templates compiled once into JSON fragments, filled in by `render`
+
+    Rendering joins the fragments with the escaped values, with no copy of
+    the template and no `json.dumps` of the whole document.
+    """
+
+    def __init__(self, body: dict, force: dict, body_path="body.json", force_path="force.json"):
+        check_template(body, force, body_path, force_path)
+        document = copy.deepcopy(body)
+        link = document["document"][0]["c"][0]
+        link["t"] = _MARKER.format("title")
+        link["u"] = _MARKER.format("url")
+        link["f"][0][2] = _MARKER.format("length")
+        document["document"][1]["id"] = _MARKER.format("image_id")
+        for element in document["document"][2]["c"]:
+            if "u" in element:
+                element["u"] = element["u"].format(
+                    username=_MARKER.format("username"), comment_id=_MARKER.format("comment_id")
+                )
+        self._plain = self._compile(document)
+        document["document"] = [force] + document["document"]
+        self._forced = self._compile(document)
+
+    @classmethod
+    def from_files(cls, body_path: str, force_path: str) -> "RichtextTemplate":
+        with open(body_path, encoding="utf8") as fbody:
+            body = json.load(fbody)
+        with open(force_path, encoding="utf8") as fforce:
+            force = json.load(fforce)
+        return cls(body, force, body_path, force_path)
+
+    @staticmethod
+    def _compile(document: dict) -> list[str | tuple[str, bool]]:
+        """Literal JSON and (slot, whole value) in order"""
+        parts: list[str | tuple[str, bool]] = []
+        text = json.dumps(document)
+        end = 0
+        for match in _SLOT_RE.finditer(text):
+            parts.append(text[end : match.start()])
+            if match.group(1):
+                parts.append((match.group(1), True))
+            else:
+                parts.append((match.group(2), False))
+            end = match.end()
+        parts.append(text[end:])
+        return parts
+
+    def render(
+        self, title: str, url: str, image_id: str, username: str, comment_id: str, force=False
+    ) -> str:
+        """The richtext_json of a reply, serialized"""
+        values = {
+            "title": title,
+            "url": url,
+            "length": len(title),
+            "image_id": image_id,
+            "username": username,
+            "comment_id": comment_id,
+        }
+        out = []
+        for part in self._forced if force else self._plain:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            name, whole = part
+            value = json.dumps(values[name])
+            out.append(value if whole else value[1:-1])
+        return "".join(out)
@@ -0,0 +1,218 @@
+"""Items of the streams already processed, remembered across restarts"""
+
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+_logger = logging.getLogger("ImmaginiBot")
+
+# magic, bits of each generation, hashes, items in the current generation,
+# capacity of a generation, index of the current generation
+_HEADER = struct.Struct("<8sQIQQI")
+_MAGIC = b"IBSEEN01"
+
+SEEN_PATH = os.path.join("config", "seen")
+
+
+class BloomFilter:
+    """Two generations of a bloom filter in a memory-mapped file
+
+    The current generation takes `capacity` ids, then becomes the previous
+    one and a new empty generation starts: the last `capacity` ids at least
+    are always remembered, with a false positive rate of about `error_rate`.
+    """
+
+    def __init__(self, path: str, capacity=100_000, error_rate=0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("capacity must be positive and error_rate between 0 and 1")
+        self.path = path
+        self.capacity = capacity
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        # whole bytes
+        self.bits = (bits + 7) // 8 * 8
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._size = self.bits // 8
+        self._lock = threading.Lock()
+        self._file, self._map = self._open()
+        _, _, _, self._count, _, self._current = _HEADER.unpack_from(self._map)
+
+    def _open(self):
+        length = _HEADER.size + 2 * self._size
+        fileobj = open(self.path, "a+b")
+        fileobj.seek(0)
+        header = fileobj.read(_HEADER.size)
+        expected = (_MAGIC, self.bits, self.hashes)
+        if len(header) < _HEADER.size or _HEADER.unpack(header)[:3] != expected:
+            if header:
+                _logger.info("Starting a new %s, size or error rate changed", self.path)
+            fileobj.truncate(0)
+            fileobj.write(_HEADER.pack(_MAGIC, self.bits, self.hashes, 0, self.capacity, 0))
+            fileobj.truncate(length)
+            fileobj.flush()
+        return fileobj, mmap.mmap(fileobj.fileno(), length)
+
+    def _positions(self, key: str) -> list[int]:
+        digest = hashlib.blake2b(key.encode("utf8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def _has(self, generation: int, positions: list[int]) -> bool:
+        offset = _HEADER.size + generation * self._size
+        data = self._map
+        return all(data[offset + (p >> 3)] & (1 << (p & 7)) for p in positions)
+
+    def __contains__(self, key: str) -> bool:
+        positions = self._positions(key)
+        with self._lock:
+            return self._has(0, positions) or self._has(1, positions)
+
+    def add(self, key: str) -> None:
+        positions = self._positions(key)
+        with self._lock:
+            if self._has(self._current, positions):
+                return
+            if self._count >= self.capacity:
+                # the oldest generation is forgotten
+                self._current = 1 - self._current
+                offset = _HEADER.size + self._current * self._size
+                self._map[offset : offset + self._size] = bytes(self._size)
+                self._count = 0
+            offset = _HEADER.size + self._current * self._size
+            for p in positions:
+                self._map[offset + (p >> 3)] |= 1 << (p & 7)
+            self._count += 1
+            _HEADER.pack_into(
+                self._map,
+                0,
+                _MAGIC,
+                self.bits,
+                self.hashes,
+                self._count,
+                self.capacity,
+                self._current,
+            )
+
+    def flush(self) -> None:
+        with self._lock:
+            self._map.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+
+
+class SeenWindow:
+    """Items of one stream already processed
+
+    An item is seen if it is older than the high-water mark of the stream,
+    minus `slack` seconds for the items arriving late, or if it is in the
+    filter. Without `use_mark` only the filter is checked. A held item is
+    seen only until the process exits, and the mark stays before it; after
+    `max_hold` seconds it is given up, neither held nor stored.
+    """
+
+    def __init__(self, store: "SeenStore", name: str, use_mark=True, slack=60.0, max_hold=600.0):
+        self._store = store
+        self.name = name
+        self.use_mark = use_mark
+        self.slack = slack
+        self.max_hold = max_hold
+        # fullname -> (created_utc, monotonic time it was held)
+        self._held: dict[str, tuple[float, float]] = {}
+
+    def __contains__(self, item) -> bool:
+        if item.fullname in self._held:
+            return True
+        if self.use_mark:
+            mark = self._store.marks.get(self.name)
+            if mark is not None and item.created_utc < mark[1] - self.slack:
+                return True
+        return item.fullname in self._store.ids
+
+    def hold(self, item) -> None:
+        """Seen in this run while it is processed, stored by `add` once done"""
+        with self._store.lock:
+            self._expire()
+            self._held[item.fullname] = (item.created_utc, time.monotonic())
+
+    def add(self, item) -> None:
+        with self._store.lock:
+            self._store.ids.add(item.fullname)
+            self._held.pop(item.fullname, None)
+            self._expire()
+            if not self.use_mark:
+                return
+            created_utc = item.created_utc
+            if self._held:
+                # a restart must not skip the items still held
+                created_utc = min(created_utc, *(c for c, _ in self._held.values()))
+            self._store.mark(self.name, item.fullname, created_utc)
+
+    def _expire(self) -> None:
+        """Give up the items held for more than `max_hold` seconds, like failed replies"""
+        oldest = time.monotonic() - self.max_hold
+        expired = [k for k, (_, held_at) in self._held.items() if held_at < oldest]
+        for fullname in expired:
+            del self._held[fullname]
+        if expired:
+            _logger.warning(
+                "Gave up %d held items of %s after %.0fs", len(expired), self.name, self.max_hold
+            )
+
+
+class SeenStore:
+    """Filter of the seen ids and high-water mark of each stream
+
+    Stored in `path`.bloom and `path`.json; `flush` writes them to disk.
+    """
+
+    def __init__(self, path: str, capacity=100_000, error_rate=0.001, max_hold=600.0):
+        self.max_hold = max_hold
+        self.ids = BloomFilter(path + ".bloom", capacity, error_rate)
+        self._marks_path = path + ".json"
+        # stream -> (fullname, created_utc) of the newest item processed
+        self.marks: dict[str, tuple[str, float]] = {}
+        try:
+            with open(self._marks_path, encoding="utf8") as infile:
+                self.marks = {k: (v[0], v[1]) for k, v in json.load(infile).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, LookupError, TypeError) as expt:
+            _logger.warning("Ignoring %s: %s", self._marks_path, expt)
+        self._dirty = False
+        # the windows are updated from the request threads as well
+        self.lock = threading.RLock()
+
+    def window(self, name: str, use_mark=True) -> SeenWindow:
+        return SeenWindow(self, name, use_mark, max_hold=self.max_hold)
+
+    def mark(self, name: str, fullname: str, created_utc: float) -> None:
+        with self.lock:
+            current = self.marks.get(name)
+            if current is None or created_utc >= current[1]:
+                self.marks[name] = (fullname, created_utc)
+                self._dirty = True
+
+    def flush(self) -> None:
+        self.ids.flush()
+        with self.lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            marks = dict(self.marks)
+        with open(self._marks_path + ".tmp", "w", encoding="utf8") as outfile:
+            json.dump(marks, outfile)
+        os.replace(self._marks_path + ".tmp", self._marks_path)
+
+    def close(self) -> None:
+        self.flush()
+        self.ids.close()
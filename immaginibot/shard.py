@@ -0,0 +1,179 @@
+"""Run several bot workers, each on its own share of the subreddits
+
+    python -m immaginibot.shard
+
+Configured by the [sharding] section of bot.toml: `sites` are the praw.ini
+sections with the credentials of each worker, `subreddits` the ones split
+among them (default: the subreddits of the first multireddit). The workers
+share config/status.sqlite3 and config/images.toml; the first one also reads
+the inbox and posts the exports.
+"""
+
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections.abc import Iterable
+
+import praw
+
+from . import models
+from .seen import SEEN_PATH
+from .utils import CountingRequestor, GracefulDeath, load_settings
+
+_logger = logging.getLogger("ImmaginiBot")
+
+
+def assign(subreddits: Iterable[str], workers: int) -> list[list[str]]:
+    """Split `subreddits` among `workers`, round robin in alphabetical order"""
+    shares: list[list[str]] = [[] for _ in range(workers)]
+    for idx, name in enumerate(sorted({s.lower() for s in subreddits})):
+        shares[idx % workers].append(name)
+    return shares
+
+
+def worker_settings(settings: dict, index: int) -> dict:
+    """Settings of the `index` worker: its own metrics port and files"""
+    settings = dict(settings)
+    worker_metrics = dict(settings.get("metrics", {}))
+    if worker_metrics.get("port"):
+        worker_metrics["port"] += index
+    if worker_metrics.get("dump_file"):
+        worker_metrics["dump_file"] += f".{index}"
+    settings["metrics"] = worker_metrics
+    seen = dict(settings.get("seen", {}))
+    seen["path"] = f"{seen.get('path', SEEN_PATH)}.{index}"
+    settings["seen"] = seen
+    return settings
+
+
+def run_worker(site: str, subreddits: list[str], primary: bool, settings: dict) -> None:
+    """Entry point of a worker process"""
+    from .bot import ImmaginiBot
+
+    reddit = praw.Reddit(site, requestor_class=CountingRequestor)
+    bot = ImmaginiBot(reddit, settings)
+    bot.stream_all(subreddits, inbox=primary)
+
+
+class Coordinator:
+    """Start a process for each worker, start again the ones that stop
+
+    A worker that stops within `stable_after` seconds waits twice as long
+    as the last time before being restarted, up to `max_restart_delay`.
+    """
+
+    def __init__(
+        self,
+        sites: list[str],
+        subreddits: Iterable[str],
+        settings: dict,
+        restart_delay=5.0,
+        max_restart_delay=300.0,
+        stable_after=600.0,
+    ):
+        shares = assign(subreddits, len(sites))
+        if not shares[0]:
+            raise ValueError("No subreddits to stream")
+        # more sites than subreddits: the last ones have nothing to do
+        self.workers = [(site, share) for site, share in zip(sites, shares, strict=True) if share]
+        self.settings = settings
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[multiprocessing.process.BaseProcess | None] = [None] * len(
+            self.workers
+        )
+        self._started = [0.0] * len(self.workers)
+        self._delays = [0.0] * len(self.workers)
+        self._restart_at: list[float | None] = [None] * len(self.workers)
+
+    def _start(self, index: int) -> None:
+        site, share = self.workers[index]
+        process = self._context.Process(
+            target=run_worker,
+            args=(site, share, index == 0, worker_settings(self.settings, index)),
+            name=f"worker-{site}",
+        )
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.monotonic()
+        self._restart_at[index] = None
+        _logger.info("Started %s (pid %d): %s", process.name, process.pid, ", ".join(share))
+
+    def _check(self, index: int) -> None:
+        process = self._processes[index]
+        if process is not None and process.is_alive():
+            return
+        now = time.monotonic()
+        restart_at = self._restart_at[index]
+        if restart_at is None:
+            if now - self._started[index] > self.stable_after:
+                self._delays[index] = self.restart_delay
+            else:
+                self._delays[index] = min(
+                    max(self._delays[index] * 2, self.restart_delay), self.max_restart_delay
+                )
+            self._restart_at[index] = now + self._delays[index]
+            _logger.warning(
+                "Worker %s exited with %s, restart in %.0fs",
+                self.workers[index][0],
+                process.exitcode if process else None,
+                self._delays[index],
+            )
+        elif now >= restart_at:
+            self._start(index)
+
+    def run(self, poll=1.0, shutdown_timeout=60.0) -> None:
+        """Keep the workers running until SIGINT or SIGTERM"""
+        sighandler = GracefulDeath()
+        for index in range(len(self.workers)):
+            self._start(index)
+        while not sighandler.received_kill:
+            for index in range(len(self.workers)):
+                self._check(index)
+            time.sleep(poll)
+        _logger.info("Stopping %d workers", len(self.workers))
+        running = [p for p in self._processes if p is not None and p.is_alive()]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + shutdown_timeout
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                _logger.warning("Killing %s", process.name)
+                process.kill()
+                process.join()
+
+
+def main():
+    """Start the workers of the [sharding] section of bot.toml"""
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    settings = load_settings()
+    sharding = settings.get("sharding", {})
+    sites = sharding.get("sites")
+    if not sites:
+        raise SystemExit("No sites in the [sharding] section of config/bot.toml")
+    subreddits = sharding.get("subreddits")
+    if not subreddits:
+        reddit = praw.Reddit(sites[0])
+        multireddit = reddit.user.me().multireddits()[0]
+        subreddits = [s.display_name for s in multireddit.subreddits]
+    if not os.path.exists(models.STATUS_DB):
+        # the journal cannot be shared among processes
+        copied = models.switch_to_sqlite()
+        _logger.info("Copied %d comments to %s", copied, models.STATUS_DB)
+    coordinator = Coordinator(
+        sites,
+        subreddits,
+        settings,
+        restart_delay=sharding.get("restart_delay", 5.0),
+        max_restart_delay=sharding.get("max_restart_delay", 300.0),
+    )
+    coordinator.run()
+
+
+if __name__ == "__main__":
+    main()
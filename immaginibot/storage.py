@@ -0,0 +1,222 @@
+"""Persistence of the bot replies"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections.abc import Callable, Iterator
+from dataclasses import asdict
+from typing import Any
+
+import toml
+
+_logger = logging.getLogger("ImmaginiBot")
+
+
+class JournalStore:
+    """Replies kept in memory by `parent_id`, persisted to an append-only journal
+
+    Every save appends one JSON line, the last line of a `parent_id` wins.
+    The journal is rewritten with only the live entries when it grows past
+    `compact_ratio` times their number.
+    """
+
+    def __init__(self, path: str, factory: Callable[..., Any], compact_ratio=2, min_compact=1000):
+        self.path = path
+        self._factory = factory
+        self._compact_ratio = compact_ratio
+        self._min_compact = min_compact
+        self._items: dict[str, Any] = {}
+        self._by_id: dict[str, str] = {}
+        self._lines = 0
+        self._outfile = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Replay the journal"""
+        self._items.clear()
+        self._by_id.clear()
+        self._lines = 0
+        try:
+            with open(self.path, encoding="utf8") as infile:
+                for line in infile:
+                    self._lines += 1
+                    try:
+                        item = self._factory(**json.loads(line))
+                    except (ValueError, TypeError):
+                        # most likely a write cut short by a crash
+                        _logger.warning("Invalid line %d in %s", self._lines, self.path)
+                        continue
+                    self._items[item.parent_id] = item
+                    self._by_id[item.id] = item.parent_id
+        except FileNotFoundError:
+            return
+
+    def migrate_from_toml(self, toml_path: str) -> bool:
+        """Import the old status.toml, only if there is no journal yet"""
+        if os.path.exists(self.path) or not os.path.exists(toml_path):
+            return False
+        with open(toml_path, encoding="utf8") as infile:
+            tstatus = toml.load(infile)
+        self._items.clear()
+        # newer copies of an entry were prepended to comments_old
+        for c in list(reversed(tstatus.get("comments_old", []))) + tstatus.get("comments", []):
+            item = self._factory(**c)
+            self._items[item.parent_id] = item
+            self._by_id[item.id] = item.parent_id
+        self.compact()
+        _logger.info("Migrated %d comments from %s", len(self._items), toml_path)
+        return True
+
+    def get(self, parent_id: str) -> Any:
+        return self._items.get(parent_id)
+
+    def get_by_id(self, id: str) -> Any:
+        return self._items.get(self._by_id.get(id, ""))
+
+    def values(self) -> Iterator[Any]:
+        return iter(self._items.values())
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def save(self, item) -> None:
+        """Store `item` and append it to the journal"""
+        with self._lock:
+            self._items[item.parent_id] = item
+            self._by_id[item.id] = item.parent_id
+            if self._outfile is None:
+                self._outfile = open(self.path, "a", encoding="utf8")
+            self._outfile.write(json.dumps(asdict(item)) + "\n")
+            self._outfile.flush()
+            self._lines += 1
+            if self._lines > max(self._min_compact, self._compact_ratio * len(self._items)):
+                self._compact()
+
+    def compact(self) -> None:
+        """Rewrite the journal with one line for each entry"""
+        with self._lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        self._close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as outfile:
+            for item in self._items.values():
+                outfile.write(json.dumps(asdict(item)) + "\n")
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._items)
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._outfile is not None:
+            self._outfile.close()
+            self._outfile = None
+
+
+class SqliteStore:
+    """Replies stored in a SQLite database, nothing is kept in memory
+
+    Same interface as `JournalStore`, suited to a long history or to several
+    processes sharing it.
+    """
+
+    COLUMNS = ("id", "parent_id", "parent_author", "deleted", "richtext")
+
+    def __init__(self, path: str, factory: Callable[..., Any]):
+        self.path = path
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS comments ("
+                "parent_id TEXT PRIMARY KEY, id TEXT NOT NULL, parent_author TEXT NOT NULL, "
+                "deleted INTEGER NOT NULL DEFAULT 0, richtext INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS comments_id ON comments (id)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS comments_parent_author ON comments (parent_author)"
+            )
+        return self._conn
+
+    def _make(self, row) -> Any:
+        if row is None:
+            return None
+        id, parent_id, parent_author, deleted, richtext = row
+        return self._factory(id, parent_id, parent_author, bool(deleted), bool(richtext))
+
+    def _query(self, where: str, *params) -> Iterator[Any]:
+        columns = ", ".join(self.COLUMNS)
+        with self._lock:
+            rows = self.conn.execute(f"SELECT {columns} FROM comments {where}", params).fetchall()
+        return (self._make(row) for row in rows)
+
+    def load(self) -> None:
+        """Open the database"""
+        with self._lock:
+            _ = self.conn
+
+    def get(self, parent_id: str) -> Any:
+        return next(self._query("WHERE parent_id = ?", parent_id), None)
+
+    def get_by_id(self, id: str) -> Any:
+        return next(self._query("WHERE id = ?", id), None)
+
+    def get_by_author(self, parent_author: str) -> list[Any]:
+        return list(self._query("WHERE parent_author = ?", parent_author))
+
+    def values(self) -> Iterator[Any]:
+        return self._query("")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT count(*) FROM comments").fetchone()[0]
+
+    def save(self, item) -> None:
+        self.save_many([item])
+
+    def save_many(self, items) -> None:
+        """Store all `items` in a single transaction"""
+        rows = ((i.id, i.parent_id, i.parent_author, i.deleted, i.richtext) for i in items)
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO comments "
+                    f"({', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+if __name__ == "__main__":
+    # switch to SQLite: copy the journal, the bot will use the database from now on
+    from .models import STATUS_DB, STATUS_JOURNAL, switch_to_sqlite
+
+    try:
+        copied = switch_to_sqlite()
+    except FileExistsError:
+        raise SystemExit(f"{STATUS_DB} already exists") from None
+    print(f"Copied {copied} comments from {STATUS_JOURNAL} to {STATUS_DB}")
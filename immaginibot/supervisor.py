@@ -0,0 +1,109 @@
+"""When to open a stream again after an error"""
+
+import logging
+import random
+import time
+from collections.abc import Callable
+
+from . import metrics
+
+_logger = logging.getLogger("ImmaginiBot")
+
+
+class StreamSupervisor:
+    """Jittered exponential backoff and circuit breaker of one stream
+
+    After the n-th error in a row the stream waits `base_delay` * 2^(n-1)
+    seconds, at most `max_delay`, less a random fraction up to `jitter`.
+    After `threshold` errors in a row the breaker opens: the stream waits
+    `cooldown` seconds, then gets a single attempt. The errors end when the
+    stream catches up, at its first pause.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        base_delay=1.0,
+        max_delay=120.0,
+        jitter=0.5,
+        threshold=8,
+        cooldown=600.0,
+        clock: Callable[[], float] = time.monotonic,
+        rnd: Callable[[], float] = random.random,
+    ):
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._rnd = rnd
+        self.failures = 0
+        self._retry_at = 0.0
+        # first error of the current outage
+        self._outage_start: float | None = None
+        # when the stream was opened, until it catches up
+        self._opened: float | None = None
+        metrics.STREAM_BREAKER_OPEN.set(0, stream=name)
+
+    @property
+    def breaker_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def remaining(self) -> float:
+        """Seconds before the stream can be opened again"""
+        return max(self._retry_at - self._clock(), 0.0)
+
+    def ready(self) -> bool:
+        return self.remaining() == 0.0
+
+    def wait(self, sighandler, step=0.5) -> None:
+        """Sleep until `ready`, or until `sighandler` gets a kill"""
+        while not sighandler.received_kill and not self.ready():
+            time.sleep(min(step, self.remaining()))
+
+    def opened(self) -> None:
+        """A new stream was opened: it starts catching up"""
+        self._opened = self._clock()
+
+    def caught_up(self) -> None:
+        """The stream paused: the backlog is processed, the outage is over"""
+        now = self._clock()
+        if self._opened is not None:
+            metrics.STREAM_CATCHUP_SECONDS.observe(now - self._opened, stream=self.name)
+            self._opened = None
+        if self._outage_start is None:
+            return
+        outage = now - self._outage_start
+        metrics.STREAM_OUTAGE_SECONDS.observe(outage, stream=self.name)
+        _logger.info("Stream %s back after %.0fs, %d errors", self.name, outage, self.failures)
+        if self.breaker_open:
+            metrics.STREAM_BREAKER_OPEN.set(0, stream=self.name)
+        self._outage_start = None
+        self.failures = 0
+
+    def failure(self, expt: BaseException) -> float:
+        """Record an error of the stream, return the seconds before the next attempt"""
+        now = self._clock()
+        metrics.STREAM_FAILURES.inc(stream=self.name)
+        if self._outage_start is None:
+            self._outage_start = now
+        self._opened = None
+        self.failures += 1
+        if self.breaker_open:
+            delay = self.cooldown
+            metrics.STREAM_BREAKER_OPEN.set(1, stream=self.name)
+            _logger.warning(
+                "Stream %s failed %d times, next attempt in %.0fs: %r",
+                self.name,
+                self.failures,
+                delay,
+                expt,
+            )
+        else:
+            delay = min(self.base_delay * 2 ** (self.failures - 1), self.max_delay)
+            delay *= 1 - self.jitter * self._rnd()
+            _logger.info("Stream %s failed, retry in %.1fs: %r", self.name, delay, expt)
+        self._retry_at = now + delay
+        return delay
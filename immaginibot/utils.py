@@ -1,9 +1,14 @@
 """Utils class and costants"""
 
+import os
 import re
 import signal
+import threading
+import unicodedata
 
+import toml
 from praw.models.util import BoundedSet  # noqa: F401
+from prawcore import Requestor
 
 STATIC_EXT = ["jpeg", "jpg", "png"]
 ANIM_EXT = ["gif", "avi", "gifv", "mp4"]
@@ -16,10 +21,119 @@ MAYBE_IMAGE = re.compile(
     r"^(?:[^>\n].*(?:\s|\^\'))?(\w+)\.(%s)\b" % ("|".join(ALL_EXT)), re.IGNORECASE + re.MULTILINE
 )
 
+# the extension of a MAYBE_IMAGE candidate, the word is found going back
+_IMAGE_EXT = re.compile(rf"\.({'|'.join(ALL_EXT)})\b", re.IGNORECASE)
+
+
+def scan_images(body: str, limit: int | None = None) -> list[tuple[str, str]]:
+    """Same result as `MAYBE_IMAGE.findall(body)`, in linear time
+
+    MAYBE_IMAGE finds at most one `word.ext` for each line that does not
+    start with `>`: the last one preceded by a space or by `^'`, or failing
+    that the one at the very start of the line. The separator can be the
+    newline itself, so the word starting the next line comes first and the
+    search goes on from the line after it.
+    Stop after `limit` results.
+    """
+    # (line start, line end, [(word start, end, word, ext)]) of the lines with candidates
+    lines: list[tuple[int, int, list[tuple[int, int, str, str]]]] = []
+    for match in _IMAGE_EXT.finditer(body):
+        dot = start = match.start()
+        while start > 0 and (body[start - 1].isalnum() or body[start - 1] == "_"):
+            start -= 1
+        if start == dot:
+            continue
+        token = (start, match.end(), body[start:dot], match.group(1))
+        if lines and start < lines[-1][1]:
+            lines[-1][2].append(token)
+        else:
+            line_end = body.find("\n", start)
+            lines.append(
+                (body.rfind("\n", 0, start) + 1, len(body) if line_end < 0 else line_end, [token])
+            )
+    results: list[tuple[str, str]] = []
+    resume = 0
+    previous_end = -1
+    for idx, (start, end, tokens) in enumerate(lines):
+        found = None
+        if tokens[0][0] == start and 0 < start and previous_end != start - 1:
+            # the line before, without candidates, matches the word starting this one
+            before = body.rfind("\n", 0, start - 1) + 1
+            if resume <= before < start - 1 and body[before] != ">":
+                found = tokens[0]
+        if found is None and start >= resume:
+            if end > start and body[start] != ">":
+                following = lines[idx + 1][2][0] if idx + 1 < len(lines) else None
+                if following and following[0] == end + 1:
+                    found = following
+                else:
+                    for token in reversed(tokens):
+                        pos = token[0]
+                        if (pos >= start + 2 and body[pos - 1].isspace()) or (
+                            pos >= start + 3 and body[pos - 2 : pos] == "^'"
+                        ):
+                            found = token
+                            break
+            if found is None and tokens[0][0] == start:
+                found = tokens[0]
+        previous_end = end
+        if found is None:
+            continue
+        results.append((found[2], found[3]))
+        if limit is not None and len(results) >= limit:
+            break
+        resume = found[1]
+    return results
+
+
+class _FoldTable(dict):
+    """`str.translate` table to ascii lowercase letters and `_`, filled on demand"""
+
+    _ALLOWED = frozenset("abcdefghijklmnopqrstuvwxyz_")
+
+    def __missing__(self, codepoint: int) -> str:
+        folded = unicodedata.normalize("NFD", chr(codepoint)).encode("ascii", "ignore").decode()
+        folded = "".join(c for c in folded.lower() if c in self._ALLOWED)
+        self[codepoint] = folded
+        return folded
+
+
+_FOLD_TABLE = _FoldTable()
+
+
+def normalize_word(word: str) -> str:
+    """Strip accents, lowercase and keep only `[a-z_]`"""
+    return word.translate(_FOLD_TABLE)
+
+
 DELETE_BODY_RE = re.compile(r"^delete ([a-z0-9]{7,8})$")
 FORCE_TITLE_RE = re.compile(r"force ([a-z0-9]{7,8})$", re.I)
 
 
+def load_settings() -> dict:
+    """Read the optional config/bot.toml"""
+    try:
+        with open(os.path.join("config", "bot.toml"), encoding="utf8") as infile:
+            return toml.load(infile)
+    except FileNotFoundError:
+        return {}
+
+
+class CountingRequestor(Requestor):
+    """prawcore Requestor counting the HTTP requests made by each thread"""
+
+    _local = threading.local()
+
+    def request(self, *args, **kwargs):
+        self._local.count = CountingRequestor.count() + 1
+        return super().request(*args, **kwargs)
+
+    @classmethod
+    def count(cls) -> int:
+        """Requests made so far by the current thread"""
+        return getattr(cls._local, "count", 0)
+
+
 class GracefulDeath:
     """Catch signals to allow graceful shutdown."""
 